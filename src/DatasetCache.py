@@ -0,0 +1,291 @@
+"""
+    DatasetCache
+
+    Compiles a PhonemeDataFile into a binary file of encoded samples, so later
+    runs can memory-map it instead of re-parsing and re-encoding the text.
+
+    The file is laid out as:
+
+        'PHDC' <version:uint32> <header length:uint32> <JSON header>
+        <indices block> <labels block> <word_starts block>
+
+    The blocks start on the first 64 byte boundary after the header, and the
+    header gives each block's offset from there, its dtype and its shape:
+
+        - indices: the active feature columns of every character, as
+          produced by FeatureGenerator.FeatureEncoder.
+        - labels: the index of every character's phone in the header's
+          phone list.
+        - word_starts: the first sample of every word, plus an end marker.
+
+    A source file has one cache, next to it with CACHE_EXT added to its name.
+    The header keeps a hash of the feature configuration and the source
+    file's size and modification time, so changing either one recompiles the
+    cache in place without reading the whole source file to find out.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+from FeatureGenerator import FeatureGenerator
+from PhonemeDataFile import PhonemeDataFile
+from numpy import (arange, array, asarray, concatenate, diff, dtype, eye, int64, memmap, repeat,
+                   uint8, uint16, zeros)
+from numpy.random import RandomState
+
+MAGIC = 'PHDC'
+VERSION = 1
+ALIGN = 64
+PRELUDE = struct.Struct('<4sII')
+BLOCKS = ['indices', 'labels', 'word_starts']
+CACHE_EXT = '.pdc'
+
+class DatasetCacheError(Exception):
+    pass
+
+def align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def cache_key(feature_vals):
+    """ Hashes the feature configuration. """
+    h = hashlib.sha1()
+    h.update('%s:%d\n' % (MAGIC, VERSION))
+    h.update(json.dumps(feature_vals, sort_keys=True))
+    return h.hexdigest()
+
+def source_stamp(source):
+    """ The size and modification time of a source file, as its cache's
+    header records them.
+    """
+    st = os.stat(source)
+    return {'size': st.st_size, 'mtime': repr(st.st_mtime)}
+
+def cache_path(source):
+    """ The cache file for a source file, next to it. """
+    return source + CACHE_EXT
+
+def is_cache_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class DatasetWriter:
+    """ Writes encoded words into a new cache file in a single pass. Several
+    writers can share one phone_index so their labels line up.
+    """
+
+    FLUSH_SIZE = 1 << 16
+
+    def __init__(self, filename, fgen, key=None, source=None, phone_index=None):
+        self._filename = filename
+        self._fgen = fgen
+        self._key = key
+        self._source = source
+        self.phone_index = {} if phone_index is None else phone_index
+        self.index_dtype = uint8 if fgen.encoder.width <= 256 else uint16
+        self.num_samples = 0
+        self.num_words = 0
+        self._files = dict((name, tempfile.TemporaryFile()) for name in BLOCKS)
+        self._pending = dict((name, []) for name in BLOCKS)
+        self._num_pending = 0
+
+    def add(self, word, pron):
+        """ Adds a word and its pronunciation, as lists of characters. """
+        indices = self._fgen.word_indices(word)
+        labels = [self.phone_index.setdefault(pron[i], len(self.phone_index))
+                  for i in range(len(word))]
+        self._pending['indices'].append(indices.astype(self.index_dtype))
+        self._pending['labels'].append(array(labels, dtype=uint16))
+        self._pending['word_starts'].append(array([self.num_samples], dtype=int64))
+        self.num_samples += len(word)
+        self.num_words += 1
+        self._num_pending += len(word)
+        if self._num_pending >= DatasetWriter.FLUSH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        for name in BLOCKS:
+            if self._pending[name]:
+                concatenate(self._pending[name]).tofile(self._files[name])
+            self._pending[name] = []
+        self._num_pending = 0
+
+    def close(self):
+        """ Writes the header and blocks out to the cache file. """
+        if len(self.phone_index) > 1 << 16:
+            raise DatasetCacheError('Too many phones for a dataset cache: %d' % len(self.phone_index))
+        self._pending['word_starts'].append(array([self.num_samples], dtype=int64))
+        self._flush()
+
+        width = len(self._fgen.encoder.names)
+        shapes = {'indices': [self.num_samples, width],
+                  'labels': [self.num_samples],
+                  'word_starts': [self.num_words + 1]}
+        dtypes = {'indices': dtype(self.index_dtype).str,
+                  'labels': dtype(uint16).str,
+                  'word_starts': dtype(int64).str}
+        blocks = {}
+        offset = 0
+        for name in BLOCKS:
+            blocks[name] = {'offset': offset, 'dtype': dtypes[name], 'shape': shapes[name]}
+            offset = align(offset + self._files[name].tell())
+
+        header = json.dumps({
+            'key': self._key,
+            'source': self._source,
+            'source_stamp': source_stamp(self._source) if self._source is not None else None,
+            'features': self._fgen.feature_vals,
+            'phones': sorted(self.phone_index, key=self.phone_index.get),
+            'num_samples': self.num_samples,
+            'num_words': self.num_words,
+            'blocks': blocks,
+        }, sort_keys=True)
+
+        tmpname = self._filename + '.tmp'
+        with open(tmpname, 'wb') as out:
+            out.write(PRELUDE.pack(MAGIC, VERSION, len(header)))
+            out.write(header)
+            base = align(out.tell())
+            for name in BLOCKS:
+                out.write('\0' * (base + blocks[name]['offset'] - out.tell()))
+                f = self._files[name]
+                f.seek(0)
+                shutil.copyfileobj(f, out)
+                f.close()
+        os.rename(tmpname, self._filename)
+
+
+class DatasetCache:
+    """ A compiled data set, memory-mapped from its cache file. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            prelude = f.read(PRELUDE.size)
+            if len(prelude) < PRELUDE.size or prelude[:len(MAGIC)] != MAGIC:
+                raise DatasetCacheError('%s is not a dataset cache file.' % filename)
+            _, version, length = PRELUDE.unpack(prelude)
+            if version != VERSION:
+                raise DatasetCacheError('%s has cache version %d, expected %d; please recompile it.'
+                                        % (filename, version, VERSION))
+            try:
+                self.header = json.loads(f.read(length))
+            except ValueError:
+                raise DatasetCacheError('%s has a corrupt header.' % filename)
+
+        base = align(PRELUDE.size + length)
+        for name in BLOCKS:
+            block = self.header['blocks'][name]
+            shape = tuple(block['shape'])
+            if 0 in shape:
+                setattr(self, name, zeros(shape, dtype=block['dtype']))
+            else:
+                setattr(self, name, memmap(filename, dtype=block['dtype'], mode='r',
+                                           offset=base + block['offset'], shape=shape))
+        self.phones = [str(p) for p in self.header['phones']]
+        self.key = self.header['key']
+
+    @staticmethod
+    def compile(source, filename=None, key=None):
+        """ Parses and encodes a PhonemeDataFile into a cache file. """
+        fgen = FeatureGenerator(PhonemeDataFile(source))
+        if key is None:
+            key = cache_key(fgen.feature_vals)
+        if filename is None:
+            filename = cache_path(source)
+        writer = DatasetWriter(filename, fgen, key, source)
+        for w, p in PhonemeDataFile(source).readWordSplit():
+            writer.add(w, p)
+        writer.close()
+        return DatasetCache(filename)
+
+    @staticmethod
+    def open(source, rebuild=False):
+        """ Opens the cache for a source file, compiling it first if it is
+        missing or out of date. A cache file can also be opened directly.
+        """
+        if is_cache_file(source):
+            return DatasetCache(source)
+        key = cache_key(FeatureGenerator(None).feature_vals)
+        filename = cache_path(source)
+        if not rebuild and os.path.exists(filename):
+            try:
+                cache = DatasetCache(filename)
+                if cache.key == key and cache.header.get('source_stamp') == source_stamp(source):
+                    return cache
+            except DatasetCacheError:
+                pass
+        return DatasetCache.compile(source, filename, key)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def num_words(self):
+        return len(self.word_starts) - 1
+
+    @property
+    def width(self):
+        """ The length of a dense feature vector. """
+        return sum(len(vals) for vals in self.header['features'].values())
+
+    def word_mask(self, holdout, seed=0):
+        """ Picks a repeatable holdout fraction of the words. """
+        return RandomState(seed).rand(self.num_words) < holdout
+
+    def sample_mask(self, word_mask):
+        """ Spreads a mask over words out to each of their samples. """
+        return repeat(word_mask, diff(self.word_starts))
+
+    def inputs(self, rows=slice(None), dtype=float):
+        """ Dense feature vectors for the given rows. """
+        indices = asarray(self.indices[rows], dtype=int)
+        out = zeros((len(indices), self.width), dtype=dtype)
+        if len(indices):
+            out[arange(len(indices))[:, None], indices] = 1
+        return out
+
+    def truths(self, rows=slice(None)):
+        """ Truth vectors for the given rows. """
+        return eye(len(self.phones))[asarray(self.labels[rows], dtype=int)]
+
+    def batches(self, batch_size, mask=None, shuffle=True, dense=True, chunk_size=1 << 16, rng=None):
+        """ A Generator of (inputs, truths) batches (or (indices, labels) when
+        not dense) over the rows where mask is set. Shuffling is done within
+        chunks of rows visited in random order, so memory stays bounded.
+        """
+        rng = rng or RandomState()
+        starts = range(0, len(self), chunk_size)
+        if shuffle:
+            rng.shuffle(starts)
+        for start in starts:
+            rows = arange(start, min(start + chunk_size, len(self)))
+            if mask is not None:
+                rows = rows[asarray(mask[start:start + chunk_size], dtype=bool)]
+            if shuffle:
+                rng.shuffle(rows)
+            for i in range(0, len(rows), batch_size):
+                batch = rows[i:i + batch_size]
+                if dense:
+                    yield self.inputs(batch), self.truths(batch)
+                else:
+                    yield asarray(self.indices[batch], dtype=int), asarray(self.labels[batch], dtype=int)
+
+    def words(self):
+        """ A Generator rebuilding the (word, pronunciation) line pairs of the
+        source file from the encoded samples, like PhonemeDataFile.readWord().
+        """
+        names = sorted(self.header['features'])
+        col = names.index('current_char')
+        offset = sum(len(self.header['features'][f]) for f in names[:col])
+        chars = [str(c) for c in self.header['features']['current_char']]
+        starts = self.word_starts
+        for i in range(self.num_words):
+            start, end = int(starts[i]), int(starts[i + 1])
+            word = [chars[c - offset] for c in self.indices[start:end, col]]
+            pron = [self.phones[l] for l in self.labels[start:end]]
+            yield ' '.join(word) + '\n', ' '.join(pron) + '\n'
@@ -0,0 +1,123 @@
+"""
+    Decoder
+
+    Finds the best whole-word pronunciations from the net's per-character
+    phone outputs with a beam search, instead of picking each character's
+    best phone on its own.
+
+    The net's outputs for each character are normalized into log
+    probabilities. Every step of the search extends each of the beam_width
+    best partial pronunciations by every phone at once, as one (beam x
+    phones) array of scores, and keeps the beam_width best of those. A
+    BigramModel, learned from the phone sequences of a PhonemeDataFile, can
+    add the log probability of each phone following the one before it.
+
+    With a beam width of 1 and no BigramModel this is the same as taking the
+    argmax of every character.
+"""
+
+import hashlib
+
+from PhonemeDataFile import PhonemeDataFile
+from numpy import argpartition, argsort, asarray, bincount, clip, log, zeros
+
+class BigramModel:
+    """ Log probabilities of one phone following another, with an extra
+    start row for the first phone of a word, smoothed by adding smoothing to
+    every count.
+    """
+
+    def __init__(self, phones, counts, smoothing=1.0):
+        self.phones = list(phones)
+        self.counts = asarray(counts, dtype=float)
+        self.smoothing = smoothing
+        probs = self.counts + smoothing
+        self.log_transitions = log(probs / probs.sum(axis=1)[:, None])
+
+    @staticmethod
+    def learn(filename, phones, smoothing=1.0):
+        """ Counts the phone bigrams of a data file, see
+        PhonemeDataFile.readWordMatched(). Words with phones outside of
+        phones are skipped.
+        """
+        index = dict((p, i) for i, p in enumerate(phones))
+        start = len(phones)
+        pairs = []
+        for matched in PhonemeDataFile(filename).readWordMatched():
+            seq = [index.get(p) for _, p in matched]
+            if None in seq:
+                continue
+            prev = start
+            for cur in seq:
+                pairs.append(prev * len(phones) + cur)
+                prev = cur
+        counts = zeros((len(phones) + 1) * len(phones))
+        if pairs:
+            counts = bincount(pairs, minlength=len(counts)).astype(float)
+        return BigramModel(phones, counts.reshape(len(phones) + 1, len(phones)), smoothing)
+
+    @property
+    def start(self):
+        """ The log probabilities of each phone starting a word. """
+        return self.log_transitions[-1]
+
+    def fingerprint(self):
+        h = hashlib.sha1()
+        h.update(repr((self.phones, self.smoothing)))
+        h.update(self.counts.tostring())
+        return h.hexdigest()
+
+
+def log_distributions(outputs, floor=1e-6):
+    """ Normalizes each row of net outputs into log probabilities. """
+    outputs = clip(asarray(outputs, dtype=float), floor, None)
+    return log(outputs / outputs.sum(axis=1)[:, None])
+
+def _best(scores, n):
+    """ The indices of the n highest scores, highest first. """
+    if n < len(scores):
+        top = argpartition(-scores, n - 1)[:n]
+        return top[argsort(-scores[top], kind='mergesort')]
+    return argsort(-scores, kind='mergesort')
+
+def beam_search(logprobs, beam_width=8, topk=1, bigram=None, weight=1.0):
+    """ Searches a word's (characters x phones) log probabilities for its
+    topk best pronunciations, keeping beam_width candidates at each step.
+
+    Returns a list of (phone indices, score) pairs, best first, where the
+    score is the summed log probability (plus weight times the bigram log
+    probabilities, if a BigramModel is given).
+    """
+    logprobs = asarray(logprobs, dtype=float)
+    if not len(logprobs):
+        return [([], 0.0)]
+    beam_width = max(beam_width, topk)
+    num_phones = logprobs.shape[1]
+
+    scores = logprobs[0]
+    if bigram is not None:
+        scores = scores + weight * bigram.start
+    last = _best(scores, beam_width)
+    scores = scores[last]
+    phones, parents = [last], [None]
+
+    for step in logprobs[1:]:
+        candidates = scores[:, None] + step[None, :]
+        if bigram is not None:
+            candidates += weight * bigram.log_transitions[last]
+        flat = candidates.ravel()
+        best = _best(flat, beam_width)
+        parent, last = best // num_phones, best % num_phones
+        scores = flat[best]
+        phones.append(last)
+        parents.append(parent)
+
+    results = []
+    for i in range(min(topk, len(scores))):
+        seq, b = [], i
+        for t in reversed(range(len(phones))):
+            seq.append(int(phones[t][b]))
+            if t:
+                b = parents[t][b]
+        results.append((seq[::-1], float(scores[i])))
+    return results
@@ -17,10 +17,40 @@
     the phoneme that goes with that a character represented by the features.
 """
 
+import random
 import string
 from network import class_to_truth
-from numpy import mat, zeros, cov, dot
-from numpy.linalg import eigh
+from PhonemeDataFile import hash_fraction
+from numpy import arange, array, asarray, atleast_2d, dot, empty, eye, float32, int8, mat, outer, zeros
+
+class FeatureEncoder:
+    """ Compiled lookup tables for turning feature dictionaries into one-hot
+    feature vectors. The columns are laid out by sorted feature name, each
+    feature taking one column per possible value. Since only one column per
+    feature is ever set, a sample can be kept as just its active columns.
+    """
+
+    def __init__(self, feature_vals):
+        self.names = sorted(feature_vals)
+        self.offsets = {}
+        self.columns = {}
+        width = 0
+        for f in self.names:
+            self.offsets[f] = width
+            self.columns[f] = dict((v, width + i) for i, v in enumerate(feature_vals[f]))
+            width += len(feature_vals[f])
+        self.width = width
+
+    def indices(self, feats):
+        """ Returns the active column of each feature, in sorted feature order. """
+        return [self.columns[f][feats[f]] for f in self.names]
+
+    def dense(self, indices, dtype=int8):
+        """ Expands rows of active columns back into one-hot vectors. """
+        indices = atleast_2d(asarray(indices))
+        out = zeros((len(indices), self.width), dtype=dtype)
+        out[arange(len(indices))[:, None], indices] = 1
+        return out
 
 class FeatureGenerator:
     
@@ -28,6 +58,9 @@ class FeatureGenerator:
     END_OF_WORD_CHAR = "$"
     ALPHABET = [c for c in string.lowercase]
     ALL_CHARS = ALPHABET + [START_OF_WORD_CHAR, END_OF_WORD_CHAR]
+    # The features a character's window is made of; soundex is left out as
+    # it only depends on the current character.
+    WINDOW_FEATURES = ['2after_char', 'after_char', 'before_char', 'current_char']
 
     def __init__(self, datafile):
         self.__datafile = datafile
@@ -38,6 +71,7 @@ class FeatureGenerator:
             '2after_char': FeatureGenerator.ALL_CHARS,
             'soundex':[0,1,2,3,4,5,6,7,8,9]
         }
+        self.encoder = FeatureEncoder(self.feature_vals)
         self._features = []
         self.phones = set()
 
@@ -50,30 +84,109 @@ class FeatureGenerator:
                 f = self.__gen_features(i,w)
                 yield (f,p[i])
 
+    def gen_phone_inventory(self):
+        """ A light pass over the data file that only gathers the phones,
+        without generating any features. Returns them in a stable order.
+        """
+        for _, p in self.__datafile.readWordSplit():
+            self.phones.update(p)
+        return sorted(self.phones)
+
+    def encoded_batches(self, phones, batch_size=256, shuffle_buffer=0, holdout=None,
+                        part='train', dense=False, seed=None):
+        """ A Generator streaming the data file as batches of encoded samples,
+        so memory stays bounded by the batch and shuffle buffer sizes.
+
+        Yields (indices, labels) arrays: the active feature columns of each
+        character (see FeatureEncoder) and the index of its phone in phones.
+        With dense set, yields (inputs, truths) arrays ready for the
+        NeuralNet instead. A holdout fraction of the words (picked by
+        hash_fraction) is kept out of part 'train' and makes up part 'test'.
+        """
+        rows = self.__encoded_rows(phones, holdout, part)
+        if shuffle_buffer:
+            rows = shuffled(rows, shuffle_buffer, random.Random(seed))
+
+        truths = eye(len(phones))
+        indices, labels = [], []
+        for i, l in rows:
+            indices.append(i)
+            labels.append(l)
+            if len(indices) == batch_size:
+                yield self.__batch(indices, labels, truths, dense)
+                indices, labels = [], []
+        if indices:
+            yield self.__batch(indices, labels, truths, dense)
+
+    def __encoded_rows(self, phones, holdout, part):
+        phone_index = dict((p, i) for i, p in enumerate(phones))
+        for w, p in self.__datafile.readWordSplit():
+            if holdout is not None and (hash_fraction(''.join(w)) < holdout) != (part == 'test'):
+                continue
+            for i in range(len(w)):
+                yield self.encoder.indices(self.__gen_features(i, w)), phone_index[p[i]]
+
+    def __batch(self, indices, labels, truths, dense):
+        indices, labels = array(indices), array(labels)
+        if dense:
+            return self.encoder.dense(indices, float), truths[labels]
+        return indices, labels
+
     def gen_feature_possibilities(self):
         for w,p in self.features():
             self.phones.add(p)
             self._features.append( (w,p) )
 
+    def word_indices(self, word):
+        """Given a word (as a list of characters) this will return an array
+        with one row per character, holding the active columns of that
+        character's feature vector (see FeatureEncoder).
+        """
+        return array([self.encoder.indices(self.__gen_features(i, word))
+                      for i in range(len(word))], dtype=int).reshape(len(word), len(self.encoder.names))
+
+    @property
+    def num_windows(self):
+        """ The number of distinct feature windows a character can have. """
+        num = 1
+        for f in FeatureGenerator.WINDOW_FEATURES:
+            num *= len(self.feature_vals[f])
+        return num
+
+    def window_ids(self, indices):
+        """ Packs rows of active columns (see word_indices()) into window IDs,
+        numbering the windows from 0 to num_windows - 1. Characters with the
+        same window always get the same net outputs.
+        """
+        indices = atleast_2d(asarray(indices))
+        ids = zeros(len(indices), dtype=int)
+        for f in FeatureGenerator.WINDOW_FEATURES:
+            col = self.encoder.names.index(f)
+            ids = ids * len(self.feature_vals[f]) + indices[:, col] - self.encoder.offsets[f]
+        return ids
+
+    def window_indices(self, ids):
+        """ The reverse of window_ids(), giving back rows of active columns. """
+        ids = asarray(ids, dtype=int)
+        indices = zeros((len(ids), len(self.encoder.names)), dtype=int)
+        for f in reversed(FeatureGenerator.WINDOW_FEATURES):
+            num = len(self.feature_vals[f])
+            indices[:, self.encoder.names.index(f)] = ids % num + self.encoder.offsets[f]
+            ids = ids // num
+        current = self.encoder.names.index('current_char')
+        soundex = array([self.encoder.columns['soundex'][self.__soundex_char(c)]
+                         for c in self.feature_vals['current_char']])
+        indices[:, self.encoder.names.index('soundex')] = \
+            soundex[indices[:, current] - self.encoder.offsets['current_char']]
+        return indices
+
     def word_vectors(self, word):
         """Given a word (as a list of characters) this will return the feature 
         vectors for each character to be passed into the neural net. In other
         words this will return a list of tuples (character, vector).
         """
-        wfeats = [ (word[i], self.__gen_features( i, word )) for i in range(len(word)) ]
-        numvals=0
-        offsets={}
-        for f in sorted(self.feature_vals):
-            offsets[f] = numvals
-            numvals+= len(self.feature_vals[f])
-        features_vector = []
-        for c,s in wfeats:
-            v=[0]*numvals
-            for f in self.feature_vals:
-                idx = offsets[f] + self.feature_vals[f].index(s[f])
-                v[idx]=1
-            features_vector.append( (c,v) )
-        return features_vector
+        vectors = self.encoder.dense(self.word_indices(word))
+        return zip(word, vectors)
 
     def features_vector(self, pca=None):
         """ 
@@ -87,25 +200,16 @@ class FeatureGenerator:
         self.gen_feature_possibilities()
         phones = list(self.phones)
         print "Phones: %d"%len(phones)
-        numvals = 0
-        offsets = {}
-        for f in sorted(self.feature_vals):
-            offsets[f] = numvals
-            numvals += len(self.feature_vals[f])
-       
-        features_vector = []
-        for s, t in self._features:
-            v = [0] * numvals
-            for f in self.feature_vals:
-                idx = offsets[f] + self.feature_vals[f].index(s[f])
-                v[idx] = 1
-            features_vector.append((v, class_to_truth(phones.index(t), len(phones))))
+        phone_index = dict((p, i) for i, p in enumerate(phones))
+
+        vectors = self.encoder.dense([self.encoder.indices(s) for s, _ in self._features])
+        features_vector = [(v, class_to_truth(phone_index[t], len(phones)))
+                           for v, (_, t) in zip(vectors, self._features)]
         
         if pca:
-            feats, truth = samplelist_to_mat(features_vector)
-            _, eigvecs = gen_pca(feats)
-            feats = run_pca(feats, eigvecs, pca)
-            return zip(feats.tolist(), truth.tolist()), eigvecs
+            _, eigvecs = gen_pca(vectors)
+            feats = run_pca(vectors, eigvecs, pca)
+            return zip(feats, [t for _, t in features_vector]), eigvecs
         else:
             return features_vector, None
 
@@ -137,6 +241,22 @@ class FeatureGenerator:
         for (l,r) in [("h",7),("w",8),("y",9)]: #unknown by soundex.
             if c in l: return r
     
+def shuffled(iterable, buffer_size, rng=random):
+    """ A Generator shuffling a stream through a bounded buffer: each new item
+    replaces a random item of the buffer, which is emitted in its place.
+    """
+    buf = []
+    for item in iterable:
+        if len(buf) < buffer_size:
+            buf.append(item)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buf[i]
+        buf[i] = item
+    rng.shuffle(buf)
+    for item in buf:
+        yield item
+
 def samplelist_to_mat(samples):
     """Converts a list of samples into a matrix.
 
@@ -153,19 +273,55 @@ def samplelist_to_mat(samples):
 
     return inputs, outputs
 
-def gen_pca(matrix):
+class IncrementalPCA:
+    """ Builds up the covariance of a data set one batch of rows at a time,
+    from the running row count, column sums and sum of outer products, so
+    the data never has to be in memory all at once.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.sums = None
+        self.products = None
+
+    def add(self, batch):
+        batch = atleast_2d(asarray(batch, dtype=float))
+        if self.sums is None:
+            self.sums = zeros(batch.shape[1])
+            self.products = zeros((batch.shape[1], batch.shape[1]))
+        self.n += len(batch)
+        self.sums += batch.sum(axis=0)
+        self.products += batch.T.dot(batch)
+
+    def covariance(self):
+        """ The sample covariance of every row added, like numpy.cov(). """
+        mean = self.sums / self.n
+        return (self.products - self.n * outer(mean, mean)) / (self.n - 1)
+
+    def components(self):
+        """ Returns (eigenvalues, eigenvectors) of the covariance, largest
+        eigenvalue first, with the eigenvectors as columns.
+        """
+        from numpy.linalg import eigh
+        eigval, eigvec = eigh(self.covariance())
+        order = eigval.argsort()[::-1]
+        return eigval[order], eigvec[:, order]
+
+def gen_pca_stream(batches):
+    """Returns (eigenvalues, eigenvectors) of the rows of a stream of batches."""
+    pca = IncrementalPCA()
+    for batch in batches:
+        pca.add(batch)
+    return pca.components()
+
+def gen_pca(matrix, chunk_size=1 << 14):
     """Returns (eigenvalues, eigenvectors) of the given matrix."""
-    c = cov(matrix.T)
-    eigval, eigvec = eigh(c)
-    svals = [v[0] for v in sorted(enumerate(eigval), key=lambda x: x[1], reverse=True)]
-    svecs = zeros(eigvec.shape)
-    for i in range(eigvec.shape[1]):
-        svecs[:,i] = eigvec[:,svals[i]]
-#    import ipdb; ipdb.set_trace()
-    return eigval, svecs
-
-def run_pca(matrix, eigvec, num_components):
-    """Performs PCA on the given matrix of data."""
-    vecs = eigvec[:, :num_components]
-    return dot(matrix, vecs)
+    return gen_pca_stream(matrix[i:i + chunk_size] for i in range(0, len(matrix), chunk_size))
 
+def run_pca(matrix, eigvec, num_components, chunk_size=1 << 14):
+    """Performs PCA on the given matrix of data, returning a float32 array."""
+    vecs = asarray(eigvec)[:, :num_components]
+    out = empty((len(matrix), num_components), dtype=float32)
+    for i in range(0, len(matrix), chunk_size):
+        out[i:i + chunk_size] = dot(asarray(matrix[i:i + chunk_size]), vecs)
+    return out
@@ -0,0 +1,177 @@
+"""
+    LookupTable
+
+    A trained net only ever sees a finite set of character windows (see
+    FeatureGenerator.window_ids()): the character before, the two after and
+    the current one, with the soundex feature fixed by the current
+    character. So the best phones of every window can be worked out once, by
+    Pronouncer.export_table(), and pronouncing becomes a table lookup per
+    character.
+
+    The table file is laid out like the dataset cache and binary net files:
+
+        'PHLT' <version:uint32> <header length:uint32> <JSON header>
+        <padding to 64 bytes> <table>
+
+    The header holds the phones, the characters of each window feature and
+    the table's topk and dtype. The table has a row of the topk best phones
+    (as indices into the phones, best first) for every window ID, as
+    little-endian uint8, or uint16 when there are more than 256 phones.
+
+    Reading a table only needs the standard library, not NumPy: the file is
+    memory-mapped and each character costs a few dictionary lookups and one
+    read from the map, so it can be embedded in latency-critical services.
+"""
+
+import json
+import mmap
+import os
+import struct
+
+MAGIC = 'PHLT'
+VERSION = 1
+ALIGN = 64
+PRELUDE = struct.Struct('<4sII')
+DTYPES = {'uint8': 'B', 'uint16': 'H'}
+
+START_OF_WORD_CHAR = '^'
+END_OF_WORD_CHAR = '$'
+
+class TableFileError(Exception):
+    pass
+
+def is_table_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def table_dtype(num_phones):
+    """ The smallest table dtype for phone indices up to num_phones. """
+    if num_phones <= 1 << 8:
+        return 'uint8'
+    if num_phones <= 1 << 16:
+        return 'uint16'
+    raise TableFileError('Too many phones for a lookup table: %d' % num_phones)
+
+def write_table(filename, header, rows):
+    """ Writes a table file from its header and the table's bytes, given as
+    an iterable of strings of whole rows in window ID order.
+    """
+    header = json.dumps(header, sort_keys=True)
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as out:
+        out.write(PRELUDE.pack(MAGIC, VERSION, len(header)))
+        out.write(header)
+        out.write('\0' * (-out.tell() % ALIGN))
+        for block in rows:
+            out.write(block)
+    os.rename(tmpname, filename)
+
+
+class LookupTable:
+    """ A memory-mapped table of the best phones of every character window. """
+
+    def __init__(self, filename):
+        self._map = None
+        self._file = open(filename, 'rb')
+        try:
+            self._open(filename)
+        except Exception:
+            self.close()
+            raise
+
+    def _open(self, filename):
+        try:
+            magic, version, length = PRELUDE.unpack(self._file.read(PRELUDE.size))
+            if magic != MAGIC:
+                raise TableFileError('%s is not a lookup table file' % filename)
+            if version != VERSION:
+                raise TableFileError('Unsupported lookup table version: %d' % version)
+            self.header = json.loads(self._file.read(length))
+        except (struct.error, ValueError) as e:
+            raise TableFileError('Corrupt lookup table file %s: %s' % (filename, e))
+
+        self.phones = [str(p) for p in self.header['phones']]
+        self.topk = self.header['topk']
+        self.alphabet = set(str(c) for c in self.header['features']['current_char'])
+        self._row = struct.Struct('<%d%s' % (self.topk, DTYPES[self.header['dtype']]))
+        self._base = PRELUDE.size + length + (-(PRELUDE.size + length) % ALIGN)
+
+        # Each window feature's character -> index times the number of
+        # windows of the features after it, so a window ID is a sum of four
+        # lookups.
+        index = {}
+        radix = 1
+        for f in reversed(self.header['window_features']):
+            chars = self.header['features'][f]
+            index[f] = dict((str(c), i * radix) for i, c in enumerate(chars))
+            radix *= len(chars)
+        self._index = [index[f] for f in ['before_char', 'current_char', 'after_char', '2after_char']]
+        self.num_windows = radix
+
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < self._base + radix * self._row.size:
+            raise TableFileError('Truncated lookup table file %s' % filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    @property
+    def fingerprint(self):
+        """ The Pronouncer fingerprint of the model the table was made from. """
+        return self.header.get('fingerprint')
+
+    def clean_word(self, word):
+        """ Lowercases a word into a list of the characters the table knows. """
+        return [c for c in word.lower() if c in self.alphabet]
+
+    def window_ids(self, word):
+        """ The window ID of each character of a word (as a list of
+        characters), the same as FeatureGenerator.window_ids().
+        """
+        before, current, after, after2 = self._index
+        padded = [START_OF_WORD_CHAR] + word + [END_OF_WORD_CHAR, END_OF_WORD_CHAR]
+        return [before[padded[i]] + current[padded[i + 1]] + after[padded[i + 2]] + after2[padded[i + 3]]
+                for i in range(len(word))]
+
+    def ranked(self, word):
+        """ The topk best phones of each character of a word (as a list of
+        characters), as lists of phone indices, best first.
+        """
+        row, m, base, size = self._row, self._map, self._base, self._row.size
+        return [row.unpack_from(m, base + i * size) for i in self.window_ids(word)]
+
+    def pronounce_word(self, word):
+        """ The best phone for each character of a word (as a list of
+        characters).
+        """
+        phones = self.phones
+        return [phones[r[0]] for r in self.ranked(word)]
+
+    def pronounce(self, words):
+        """ Returns the best phone for each character of each word, like
+        Pronouncer.pronounce().
+        """
+        return [self.pronounce_word(w) for w in words]
+
+    def pronounce_topk(self, word):
+        """ Returns the topk best phones of each character of a word, best
+        first.
+        """
+        phones = self.phones
+        return [[phones[i] for i in r] for r in self.ranked(word)]
+
+    def pronounce_block(self, block):
+        """ Pronounces a list of words as they came in, returning a list of
+        (word, chars, pronunciation) results, like Pronouncer.pronounce_block().
+        """
+        chars = [self.clean_word(w) for w in block]
+        return zip(block, chars, self.pronounce(chars))
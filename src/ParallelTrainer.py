@@ -0,0 +1,138 @@
+"""
+    ParallelTrainer
+
+    Data-parallel mini-batch training: every batch is split into one shard per
+    worker process, the workers work out their shard's gradients with
+    NeuralNet.gradients() and the coordinator adds them up and applies them
+    with NeuralNet.apply_gradients(). The sum of the shard gradients is the
+    gradient of the whole batch, so each step makes the same update as
+    backprop_batch() would, just spread over several cores.
+
+    Nothing big goes through the pipes. The weights, the batch and each
+    worker's gradients live in shared memory (multiprocessing RawArrays) that
+    the workers map once at start up; the pipes only carry the shard bounds
+    down and an acknowledgement back.
+
+        with ParallelTrainer(nn, workers=4, batch_size=256) as trainer:
+            nn.train_stream(batches, val, test, step=trainer.step)
+"""
+
+import signal
+from multiprocessing import Pipe, Process, RawArray, cpu_count
+
+from network import NeuralNet, null_timer
+from numpy import frombuffer, linspace
+
+def _views(buf, shapes):
+    """ Splits a flat shared buffer into arrays of the given shapes. """
+    flat = frombuffer(buf)
+    views, start = [], 0
+    for rows, cols in shapes:
+        views.append(flat[start:start + rows * cols].reshape(rows, cols))
+        start += rows * cols
+    return views
+
+def _worker(conn, weights, inputs, truths, grads, shapes, batch_size, learning_rate):
+    """ Computes the gradients of the shards the coordinator asks for. """
+    # Ctrl-C goes to the whole process group; leave it to the coordinator,
+    # which stops training and then closes the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    nn = NeuralNet.from_weights(_views(weights, shapes), learning_rate)
+    outputs = _views(grads, shapes)
+    inputs = _views(inputs, [(batch_size, nn.structure[0])])[0]
+    truths = _views(truths, [(batch_size, nn.structure[-1])])[0]
+    while True:
+        shard = conn.recv()
+        if shard is None:
+            break
+        start, end = shard
+        if end > start:
+            for out, grad in zip(outputs, nn.gradients(inputs[start:end], truths[start:end])):
+                out[...] = grad
+        else:
+            for out in outputs:
+                out[...] = 0
+        conn.send(True)
+    conn.close()
+
+class ParallelTrainer:
+    """ Runs the mini-batch steps of a NeuralNet across worker processes.
+    Batches can hold at most batch_size samples. workers=None means one per
+    core.
+    """
+
+    def __init__(self, nn, workers=None, batch_size=256):
+        self.nn = nn
+        self.workers = workers or cpu_count()
+        self.batch_size = batch_size
+        self._shapes = [w.shape for w in nn.weights]
+        size = sum(rows * cols for rows, cols in self._shapes)
+        num_inputs, num_outputs = nn.structure[0], nn.structure[-1]
+
+        self._weights = RawArray('d', size)
+        self._inputs = RawArray('d', batch_size * num_inputs)
+        self._truths = RawArray('d', batch_size * num_outputs)
+        self._grads = [RawArray('d', size) for _ in range(self.workers)]
+        self._weight_views = _views(self._weights, self._shapes)
+        self._input_view = _views(self._inputs, [(batch_size, num_inputs)])[0]
+        self._truth_view = _views(self._truths, [(batch_size, num_outputs)])[0]
+        self._grad_views = [_views(g, self._shapes) for g in self._grads]
+        self._conns = []
+        self._procs = []
+
+    def start(self):
+        for grads in self._grads:
+            parent, child = Pipe()
+            proc = Process(target=_worker, args=(child, self._weights, self._inputs, self._truths,
+                                                 grads, self._shapes, self.batch_size, self.nn.lr))
+            proc.daemon = True
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+        return self
+
+    def close(self):
+        """ Stops the workers, including any that have already died. """
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (IOError, EOFError):
+                pass
+            conn.close()
+        for proc in self._procs:
+            proc.join(5)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        self._conns = []
+        self._procs = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def step(self, inputs, truths, momentum=0.0, velocity=None, timer=None):
+        """ A drop in for NeuralNet.backprop_batch(), with the gradients
+        worked out by the workers.
+        """
+        timer = timer or null_timer
+        num = len(inputs)
+        if num > self.batch_size:
+            raise ValueError('Batch of %d samples is larger than the trainer\'s %d.' % (num, self.batch_size))
+        with timer('gradients'):
+            for view, weights in zip(self._weight_views, self.nn.weights):
+                view[...] = weights
+            self._input_view[:num] = inputs
+            self._truth_view[:num] = truths
+
+            bounds = linspace(0, num, len(self._conns) + 1).astype(int)
+            for conn, start, end in zip(self._conns, bounds[:-1], bounds[1:]):
+                conn.send((start, end))
+            for conn in self._conns:
+                conn.recv()
+
+            grads = [sum(views[i] for views in self._grad_views) for i in range(len(self._shapes))]
+        self.nn.apply_gradients(grads, num, momentum, velocity, timer)
@@ -19,10 +19,52 @@
        ...
        
     The set of possible states for pronunciation needs not be standard but must
-    be finite.
+    be finite. Blank lines are skipped, and gzip or bzip2 compressed files are
+    read as they are.
+
+    The file is read a large block at a time and split into lines and
+    characters in bulk; readWordBlocks() hands back each block's words as one
+    list, for callers that can work a batch at a time.
 """
 
-import fileinput
+import bz2
+import gzip
+import zlib
+from itertools import chain
+
+BLOCK_SIZE = 1 << 16
+# Lines are paired and split this many at a time, few enough that a batch's
+# words are usually done with before the garbage collector's older
+# generations get to scan them.
+PAIR_LINES = 1 << 9
+
+def hash_fraction(key, seed=0):
+    """ Maps a key (e.g. a word) to a repeatable number in [0, 1), so data can
+    be partitioned the same way on every pass without remembering anything.
+    """
+    return (zlib.crc32('%s:%s' % (seed, key)) & 0xffffffff) / 4294967296.0
+
+def open_data(filename):
+    """ Opens a data file for reading, decompressing it if it is gzip or
+    bzip2 compressed.
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(3)
+    if magic[:2] == '\x1f\x8b':
+        return gzip.open(filename, 'rb')
+    if magic == 'BZh':
+        return bz2.BZ2File(filename, 'rb')
+    return open(filename, 'r')
+
+def _pair_lines(carry, lines, split):
+    """ Pairs up the word and pronunciation lines, carried over lines first,
+    splitting them into characters if split is set. Returns the pairs and
+    the line left over, if any.
+    """
+    if split: lines = map(str.split, lines)
+    lines = carry + lines
+    end = len(lines) - len(lines) % 2
+    return zip(lines[0:end:2], lines[1:end:2]), lines[end:]
 
 class PhonemeDataFile:
 
@@ -30,24 +72,47 @@ class PhonemeDataFile:
         self._filename = filename
         self._sep = charsep
         
+    def readLines(self, block_size=BLOCK_SIZE):
+        """ A Generator for reading in the lines, returns a list of the
+        non-blank lines (without their newlines) of each block.
+        """
+        f = open_data(self._filename)
+        try:
+            rest = ''
+            while True:
+                data = f.read(block_size)
+                if not data: break
+                lines = (rest + data).split('\n')
+                rest = lines.pop()
+                yield [l for l in lines if l and not l.isspace()]
+            if rest and not rest.isspace():
+                yield [rest]
+        finally:
+            f.close()
+
+    def readWordBlocks(self, block_size=BLOCK_SIZE, split=True):
+        """ A Generator for reading in the words a batch at a time, returns a
+        list of (word, pronunciation) tuples of lists of characters, or of the
+        lines themselves if split is False, for up to PAIR_LINES lines of a
+        block.
+        """
+        carry = []
+        for lines in self.readLines(block_size):
+            for start in range(0, len(lines), PAIR_LINES):
+                pairs, carry = _pair_lines(carry, lines[start:start + PAIR_LINES], split)
+                if pairs:
+                    yield pairs
+
     def readWord(self):
         """ A Generator for reading in the words, returns a tuple of (word, pronunciation)."""
-        prev=None
-        for line in open(self._filename, 'r'):
-            if line in [' ','']: continue
-
-            if prev == None:
-                prev=line
-                continue
-            else:
-                yield (prev,line)
-                prev=None
+        for block in self.readWordBlocks(split=False):
+            for (w,p) in block:
+                yield (w+'\n', p+'\n')
 
     def readWordSplit(self):
         """ A Generator for reading in the words as tuples of lists of characters. """
-        for (w,p) in self.readWord():
-            yield (w.split(), p.split())
-        
+        return chain.from_iterable(self.readWordBlocks())
+
     def readWordMatched(self):
         """ A Generator for reading in the words as a list of tupled pairings of characters. """
         for (w,p) in self.readWordSplit():
@@ -0,0 +1,520 @@
+"""
+    Pronouncer
+
+    Pronounces words with a trained NeuralNet, a block of words at a time:
+    the feature columns of every character in the block are stacked, run
+    through the net in a single batched pass, and the best phone of each
+    character is picked with an argmax.
+
+    Words are lowercased, and characters outside FeatureGenerator.ALPHABET
+    are dropped before pronouncing.
+
+    For large word lists, parallel_pronounce() spreads the blocks over a pool
+    of worker processes, each of which loads the net once when it starts.
+
+    Since a few words make up most requests, a PronunciationCache can sit in
+    front of the net. It is tied to the model it was filled by, so a cache
+    saved to disk is only reused with that same model.
+
+    Below that, a WindowCache keeps the net outputs of each character window
+    (see FeatureGenerator.window_ids()), so characters sharing a window with
+    any earlier character, in any word, skip the net entirely.
+
+    With use_beam(), whole words are decoded with a beam search instead of
+    the argmax, optionally scored by a BigramModel, see Decoder.
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict, deque
+from itertools import islice
+
+from FeatureGenerator import FeatureGenerator
+from network import NetFileError, NeuralNet, loadNN
+from numpy import (arange, argsort, asarray, ascontiguousarray, concatenate, cumsum, dtype, empty, float32, int32,
+                   unique, vstack, zeros)
+
+OUTPUT_FORMATS = ['tsv', 'chars', 'json']
+
+def clean_word(word):
+    """ Lowercases a word into a list of the characters the net knows. """
+    return [c for c in word.lower() if c in FeatureGenerator.ALPHABET]
+
+def read_words(lines):
+    """ A Generator of the words in a stream of lines, one word per line. """
+    for line in lines:
+        word = line.strip()
+        if word:
+            yield word
+
+def word_blocks(words, block_size):
+    """ A Generator splitting a stream of words into lists of block_size. """
+    words = iter(words)
+    while True:
+        block = list(islice(words, block_size))
+        if not block:
+            return
+        yield block
+
+def write_pronunciations(results, out, fmt='tsv'):
+    """ Writes (word, chars, pronunciation) results to out in the given
+    format. Returns the number of words written.
+    """
+    count = 0
+    for word, chars, pron in results:
+        out.write(format_pronunciation(word, chars, pron, fmt))
+        out.write('\n')
+        count += 1
+    return count
+
+def format_pronunciation(word, chars, pron, fmt='tsv'):
+    """ Formats a pronounced word for output, without a trailing newline. """
+    if fmt == 'tsv':
+        return '%s\t%s' % (word, ' '.join(pron))
+    elif fmt == 'chars':
+        lines = ['For word: %s' % word]
+        lines.extend('char: %s, pronunciation: %s' % (c, p) for c, p in zip(chars, pron))
+        return '\n'.join(lines)
+    elif fmt == 'json':
+        return json.dumps({'word': word, 'pronunciation': pron})
+    raise ValueError('Unknown output format: %s' % fmt)
+
+
+def model_fingerprint(pcas, phones, nn):
+    """ A hash identifying a model by its phones, PCA basis and weights. """
+    h = hashlib.sha1()
+    h.update(json.dumps(phones))
+    for block in ([] if pcas is None else [pcas]) + list(nn.weights):
+        h.update(str(block.shape))
+        h.update(ascontiguousarray(block).tostring())
+    return h.hexdigest()
+
+
+class PronunciationCache:
+    """ A bounded word -> pronunciation cache for one model, evicting the
+    least recently used word when it is full.
+    """
+
+    def __init__(self, model, max_size=100000):
+        self.model = model
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, word):
+        """ Returns the cached pronunciation of a word, or None. """
+        try:
+            pron = self._entries.pop(word)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[word] = pron
+        self.hits += 1
+        return pron
+
+    def put(self, word, pron):
+        self._entries.pop(word, None)
+        self._entries[word] = pron
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self),
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+    def save(self, filename):
+        """ Writes the cache to a file, least recently used word first. """
+        with open(filename + '.tmp', 'w') as f:
+            json.dump({'model': self.model, 'entries': self._entries.items()}, f)
+        os.rename(filename + '.tmp', filename)
+
+    @staticmethod
+    def load(filename, model, max_size=100000):
+        """ Warm-starts a cache from a file saved by save(). The file is
+        ignored if it is missing, unreadable or was filled by another model.
+        """
+        cache = PronunciationCache(model, max_size)
+        try:
+            with open(filename) as f:
+                dat = json.load(f)
+        except (IOError, ValueError):
+            return cache
+        if dat.get('model') == model:
+            for word, pron in dat['entries']:
+                cache.put(str(word), [str(p) for p in pron])
+        return cache
+
+
+class WindowCache:
+    """ Net outputs by window ID, for one model. Windows are looked up through
+    a table with a slot for every possible window, so a whole batch is
+    looked up at once. Once max_size windows are stored the cache starts
+    over empty. hits and misses count character positions, so a window
+    missing twice in one batch is two misses even though it is run once.
+    """
+
+    def __init__(self, num_windows, num_outputs, max_size=1 << 16):
+        self.max_size = min(max_size, num_windows)
+        self.hits = 0
+        self.misses = 0
+        self._slots = zeros(num_windows, dtype=int32) - 1
+        self._outputs = empty((self.max_size, num_outputs), dtype=float32)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def clear(self):
+        self._slots[:] = -1
+        self._size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self),
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+    def outputs(self, ids, run):
+        """ Returns the outputs for each window ID, calling run() with the
+        IDs of any windows not yet cached to get their outputs.
+        """
+        slots = self._slots[ids]
+        new = unique(ids[slots < 0])
+        if self._size + len(new) > self.max_size:
+            self.clear()
+            slots = self._slots[ids]
+            new = unique(ids)
+        found = slots >= 0
+        self.hits += found.sum()
+        self.misses += len(ids) - found.sum()
+        if len(new) == 0:
+            return self._outputs[slots]
+
+        computed = run(new)
+        if len(new) <= self.max_size:
+            new_slots = arange(self._size, self._size + len(new))
+            self._outputs[new_slots] = computed
+            self._slots[new] = new_slots
+            self._size += len(new)
+
+        out = empty((len(ids), self._outputs.shape[1]), dtype=float32)
+        out[found] = self._outputs[slots[found]]
+        out[~found] = computed[new.searchsorted(ids[~found])]
+        return out
+
+    def precompute(self, run, batch_size=1 << 14):
+        """ Fills the cache with every window, when it has room for them all. """
+        num_windows = len(self._slots)
+        if self.max_size < num_windows:
+            raise ValueError('A full window cache needs max_size >= %d' % num_windows)
+        self.clear()
+        for start in range(0, num_windows, batch_size):
+            ids = arange(start, min(start + batch_size, num_windows))
+            self._outputs[ids] = run(ids)
+        self._slots[:] = arange(num_windows)
+        self._size = num_windows
+
+
+def fold_pca(nn, pcas):
+    """ Folds the PCA projection a net was trained behind into its first
+    layer. Projecting a one-hot vector and multiplying by the first layer
+    is the same as multiplying by (eigenvectors x first layer), so the
+    folded net runs straight on the feature columns, see run_indices().
+    """
+    weights = asarray(nn.weights[0])
+    vecs = asarray(pcas)[:, :nn.structure[0]]
+    first = vstack((weights[:1], vecs.dot(weights[1:])))
+    return NeuralNet.from_weights([first] + list(nn.weights[1:]), nn.lr)
+
+
+class Pronouncer:
+
+    def __init__(self, pcas, phones, nn, cache=None):
+        self.pcas = pcas
+        self.phones = phones
+        self.nn = nn
+        self.cache = cache
+        self.window_cache = None
+        self.fgen = FeatureGenerator(None)
+        self._fingerprint = None
+        self._net = nn if pcas is None else fold_pca(nn, pcas)
+        self.precision = None
+        self.beam_width = 0
+        self.bigram = None
+
+    @staticmethod
+    def load(nnfile, cache_size=0, cache_file=None, window_cache_size=0, beam_width=0, bigram_file=None,
+             precision=None):
+        """ Loads a Pronouncer from a NeuralNet file, see network.loadNN(),
+        with a cache of cache_size words (warm-started from cache_file) in
+        front of the net, and a cache of window_cache_size character windows
+        (-1 for every window, precomputed). With beam_width, words are
+        decoded by a beam search, scored by the phone bigrams of bigram_file
+        if given. With precision, the net is compiled, see use_precision().
+        """
+        pronouncer = Pronouncer(*loadNN(nnfile))
+        if precision is not None:
+            pronouncer.use_precision(precision)
+        if beam_width > 0:
+            bigram = None
+            if bigram_file is not None:
+                from Decoder import BigramModel
+                bigram = BigramModel.learn(bigram_file, pronouncer.phones)
+            pronouncer.use_beam(beam_width, bigram)
+        if window_cache_size:
+            pronouncer.use_window_cache(window_cache_size)
+        if cache_size > 0:
+            if cache_file is None:
+                pronouncer.cache = PronunciationCache(pronouncer.fingerprint, cache_size)
+            else:
+                pronouncer.cache = PronunciationCache.load(cache_file, pronouncer.fingerprint, cache_size)
+        return pronouncer
+
+    @property
+    def fingerprint(self):
+        """ The model_fingerprint() of this Pronouncer's model. """
+        if self._fingerprint is None:
+            self._fingerprint = model_fingerprint(self.pcas, self.phones, self.nn)
+            if self.beam_width or self.precision:
+                decoder = 'beam:%d:%s:%s' % (self.beam_width, self.bigram and self.bigram.fingerprint(),
+                                             self.precision)
+                self._fingerprint = hashlib.sha1(self._fingerprint + decoder).hexdigest()
+        return self._fingerprint
+
+    def use_precision(self, precision='float32'):
+        """ Runs the net as a network.CompiledNet of the given precision
+        instead, trading exactness for throughput. Set it before any
+        WindowCache, which keeps the outputs of the net it was filled by.
+        """
+        net = self.nn if self.pcas is None else fold_pca(self.nn, self.pcas)
+        self._net = net.compile(precision)
+        self.precision = precision
+        self._fingerprint = None
+
+    def use_beam(self, beam_width=8, bigram=None):
+        """ Decodes words with a beam search of beam_width, scored by an
+        optional BigramModel, instead of the argmax of each character.
+        """
+        self.beam_width = beam_width
+        self.bigram = bigram
+        self._fingerprint = None
+
+    def use_window_cache(self, max_size=1 << 16):
+        """ Puts a WindowCache of max_size windows in front of the net. With
+        max_size -1, every window is run through the net up front instead,
+        which holds fgen.num_windows (570,752) float32 outputs per phone.
+        """
+        num_windows = self.fgen.num_windows
+        if max_size < 0:
+            self.window_cache = WindowCache(num_windows, self.nn.num_outputs, num_windows)
+            self.window_cache.precompute(self._run_windows)
+        else:
+            self.window_cache = WindowCache(num_windows, self.nn.num_outputs, max_size)
+
+    def outputs(self, words):
+        """ Runs every character of the words (as lists of characters) through
+        the net in one pass. Returns the (characters x phones) outputs.
+        """
+        if not words:
+            return zeros((0, self.nn.num_outputs))
+        indices = concatenate([self.fgen.word_indices(w) for w in words])
+        if self.window_cache is None:
+            return self._run(indices)
+        return self.window_cache.outputs(self.fgen.window_ids(indices), self._run_windows)
+
+    def _run(self, indices):
+        return self._net.run_indices(indices)
+
+    def _run_windows(self, ids):
+        return self._run(self.fgen.window_indices(ids))
+
+    def export_table(self, filename, topk=1, batch_size=1 << 14):
+        """ Runs every window through the net, a batch at a time, and writes
+        the topk best phones of each to a LookupTable file. Ties go to the
+        first phone, as with the argmax.
+        """
+        from LookupTable import table_dtype, write_table
+        table_type = table_dtype(len(self.phones))
+        little = dtype(table_type).newbyteorder('<')
+        topk = min(topk, len(self.phones))
+        num_windows = self.fgen.num_windows
+
+        def rows():
+            for start in range(0, num_windows, batch_size):
+                outputs = self._run_windows(arange(start, min(start + batch_size, num_windows)))
+                if topk == 1:
+                    ranked = outputs.argmax(axis=1)
+                else:
+                    ranked = argsort(-outputs, axis=1, kind='mergesort')[:, :topk]
+                yield ascontiguousarray(ranked, dtype=little).tostring()
+
+        write_table(filename, {
+            'phones': self.phones,
+            'topk': topk,
+            'dtype': table_type,
+            'window_features': FeatureGenerator.WINDOW_FEATURES,
+            'features': dict((f, self.fgen.feature_vals[f]) for f in FeatureGenerator.WINDOW_FEATURES),
+            'num_windows': num_windows,
+            'fingerprint': self.fingerprint,
+            'precision': self.precision,
+        }, rows())
+        return num_windows
+
+    def pronounce(self, words):
+        """ Returns the best phone for each character of each word (as lists
+        of characters, see clean_word()), going through the cache if any.
+        """
+        if self.cache is None:
+            return self._pronounce(words)
+
+        keys = [''.join(w) for w in words]
+        prons = [self.cache.get(k) for k in keys]
+        missing = OrderedDict()
+        for i, pron in enumerate(prons):
+            if pron is None:
+                missing.setdefault(keys[i], words[i])
+        found = dict(zip(missing, self._pronounce(missing.values())))
+        for key, pron in found.items():
+            self.cache.put(key, pron)
+        return [found[k] if p is None else p for k, p in zip(keys, prons)]
+
+    def pronounce_topk(self, words, topk=1):
+        """ Returns the topk best whole-word pronunciations of each word, as
+        lists of (pronunciation, log probability) pairs, best first. The
+        beam width is the one from use_beam(), and at least topk.
+        """
+        from Decoder import beam_search, log_distributions
+        logprobs = log_distributions(self.outputs(words))
+        ends = cumsum([len(w) for w in words])
+        results = []
+        for w, end in zip(words, ends):
+            found = beam_search(logprobs[end - len(w):end], self.beam_width, topk, self.bigram)
+            results.append([([self.phones[i] for i in seq], score) for seq, score in found])
+        return results
+
+    def _pronounce(self, words):
+        if self.beam_width:
+            return [found[0][0] for found in self.pronounce_topk(words)]
+        best = self.outputs(words).argmax(axis=1)
+        ends = cumsum([len(w) for w in words])
+        return [[self.phones[i] for i in best[end - len(w):end]] for w, end in zip(words, ends)]
+
+    def pronounce_block(self, block):
+        """ Pronounces a list of words as they came in, returning a list of
+        (word, chars, pronunciation) results.
+        """
+        chars = [clean_word(w) for w in block]
+        return zip(block, chars, self.pronounce(chars))
+
+    def pronounce_stream(self, words, out, fmt='tsv', block_size=1024):
+        """ Pronounces a stream of words a block at a time, writing each one
+        to out in the given format. Returns the number of words written.
+        """
+        results = (r for block in word_blocks(words, block_size) for r in self.pronounce_block(block))
+        return write_pronunciations(results, out, fmt)
+
+
+_worker_pronouncer = None
+_worker_error = None
+_shared_window_cache = None
+
+def _init_worker(nnfile, cache_size, cache_file, window_cache_size, beam_width, bigram_file, precision):
+    # An initializer that raises only makes the pool start another worker,
+    # so a bad net file is kept and raised from each block instead.
+    global _worker_pronouncer, _worker_error
+    try:
+        if _shared_window_cache is not None:
+            window_cache_size = 0
+        _worker_pronouncer = Pronouncer.load(nnfile, cache_size, cache_file, window_cache_size,
+                                             beam_width, bigram_file, precision)
+        if _shared_window_cache is not None:
+            _worker_pronouncer.window_cache = _shared_window_cache
+    except NetFileError as e:
+        _worker_error = e
+
+def _counts(pronouncer):
+    counts = {}
+    for name, cache in [('', pronouncer.cache), ('window_', pronouncer.window_cache)]:
+        if cache is not None:
+            counts[name + 'hits'] = cache.hits
+            counts[name + 'misses'] = cache.misses
+    return counts
+
+def _pronounce_block(block):
+    if _worker_error is not None:
+        raise _worker_error
+    before = _counts(_worker_pronouncer)
+    results = _worker_pronouncer.pronounce_block(block)
+    counts = dict((k, v - before[k]) for k, v in _counts(_worker_pronouncer).items())
+    cache = _worker_pronouncer.cache
+    return results, counts, cache and cache.model
+
+def parallel_pronounce(nnfile, words, jobs=None, block_size=1024, backlog=4,
+                       cache_size=0, cache_file=None, stats=None, window_cache_size=0,
+                       beam_width=0, bigram_file=None, precision=None):
+    """ A Generator pronouncing a stream of words across a pool of worker
+    processes, yielding (word, chars, pronunciation) in input order.
+
+    Each worker loads nnfile once when it starts; only the word blocks and
+    their results travel between processes. Binary .nnb files are
+    memory-mapped, so the workers share one copy of the weights. At most
+    backlog blocks per worker are in flight, which bounds memory however
+    long the stream is.
+
+    With cache_size, each worker keeps its own PronunciationCache,
+    warm-started from cache_file, and the hits and misses (and the
+    window_hits and window_misses of any WindowCache) are added up in the
+    stats dictionary if one is given. The pronunciations that come back
+    are also put in a cache in this process, warm-started from the same
+    file, which is saved to cache_file once every word is done. window_cache_size gives each
+    worker a WindowCache, beam_width and bigram_file a beam search, and
+    precision a compiled net, see Pronouncer.load(). A precomputed
+    WindowCache (window_cache_size -1) is built once here, before the
+    workers are forked, so they all share the one copy. Raises NetFileError
+    if the workers can't load nnfile.
+    """
+    global _shared_window_cache
+    from multiprocessing import Pool, cpu_count
+    jobs = jobs or cpu_count()
+    if window_cache_size < 0:
+        _shared_window_cache = Pronouncer.load(nnfile, window_cache_size=-1, precision=precision).window_cache
+    try:
+        pool = Pool(jobs, _init_worker, (nnfile, cache_size, cache_file, window_cache_size,
+                                         beam_width, bigram_file, precision))
+    finally:
+        _shared_window_cache = None
+    pending = deque()
+    merged = []
+
+    def finish(result):
+        results, counts, model = result.get()
+        if stats is not None:
+            for name, num in counts.items():
+                stats[name] = stats.get(name, 0) + num
+        if cache_file is not None and model is not None:
+            if not merged:
+                merged.append(PronunciationCache.load(cache_file, model, cache_size))
+            for _, chars, pron in results:
+                merged[0].put(''.join(chars), pron)
+        return results
+
+    try:
+        for block in word_blocks(words, block_size):
+            pending.append(pool.apply_async(_pronounce_block, (block,)))
+            if len(pending) >= jobs * backlog:
+                for result in finish(pending.popleft()):
+                    yield result
+        while pending:
+            for result in finish(pending.popleft()):
+                yield result
+        pool.close()
+        if merged:
+            merged[0].save(cache_file)
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,207 @@
+"""
+    PronunciationServer
+
+    A long-running HTTP server that loads a NeuralNet once and pronounces
+    words for its clients. Requests arriving together are collected into
+    micro-batches by a MicroBatcher: the first request of a batch waits at
+    most the latency budget for others to join it, then the whole batch goes
+    through the net in a single pass.
+
+    Endpoints:
+
+        GET  /pronounce?word=W[&word=W...]
+        POST /pronounce              (one word per line in the body)
+            -> {"pronunciations": [{"word": W, "pronunciation": [...]}, ...]}
+        GET  /stats
+            -> request counts, p50/p99 latency in ms and queue depth.
+
+    pronounce_remote() is a small client for it.
+"""
+
+import json
+import threading
+import time
+import urllib2
+import Queue
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import deque
+from urlparse import parse_qs, urlparse
+
+class BatchRequest:
+    """ Words waiting for a MicroBatcher, with their results once done. """
+
+    def __init__(self, words):
+        self.words = words
+        self.start = time.time()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+class MicroBatcher(threading.Thread):
+    """ Collects concurrent requests into batches of up to max_batch words,
+    waiting at most max_delay seconds after the first one, and pronounces
+    each batch with a single Pronouncer.pronounce_block() call.
+    """
+
+    def __init__(self, pronouncer, max_batch=256, max_delay=0.005, history=10000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pronouncer = pronouncer
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = Queue.Queue()
+        self.latencies = deque(maxlen=history)
+        self.num_requests = 0
+        self.num_words = 0
+        self.num_batches = 0
+
+    def submit(self, words):
+        """ Pronounces a list of words, blocking until its batch is done.
+        Returns a list of (word, chars, pronunciation) results.
+        """
+        request = BatchRequest(words)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        running = True
+        while running:
+            first = self.queue.get()
+            if first is None:
+                break
+            batch = [first]
+            num_words = len(first.words)
+            deadline = first.start + self.max_delay
+            while num_words < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if request is None:
+                    running = False
+                    break
+                batch.append(request)
+                num_words += len(request.words)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        words = [w for request in batch for w in request.words]
+        try:
+            results = self.pronouncer.pronounce_block(words)
+        except Exception as e:
+            results = None
+            for request in batch:
+                request.error = e
+
+        start = 0
+        now = time.time()
+        for request in batch:
+            if results is not None:
+                request.results = results[start:start + len(request.words)]
+            start += len(request.words)
+            self.latencies.append(now - request.start)
+            request.done.set()
+        self.num_requests += len(batch)
+        self.num_words += len(words)
+        self.num_batches += 1
+
+    def stats(self):
+        """ Request counts, latency percentiles (ms) and queue depth. """
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+        return {
+            'requests': self.num_requests,
+            'words': self.num_words,
+            'batches': self.num_batches,
+            'mean_batch_words': float(self.num_words) / self.num_batches if self.num_batches else 0.0,
+            'p50_ms': percentile(0.50),
+            'p99_ms': percentile(0.99),
+            'queue_depth': self.queue.qsize(),
+        }
+
+
+class PronunciationHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/pronounce':
+            self._pronounce(parse_qs(url.query).get('word', []))
+        elif url.path == '/stats':
+            self._reply(200, self.server.batcher.stats())
+        else:
+            self._reply(404, {'error': 'Unknown path: %s' % url.path})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/pronounce':
+            self._reply(404, {'error': 'Unknown path: %s' % self.path})
+            return
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self._pronounce([line.strip() for line in body.splitlines() if line.strip()])
+
+    def _pronounce(self, words):
+        if not words:
+            self._reply(400, {'error': 'No words given.'})
+            return
+        try:
+            results = self.server.batcher.submit(words)
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+            return
+        self._reply(200, {'pronunciations': [{'word': w, 'pronunciation': p} for w, _, p in results]})
+
+    def _reply(self, code, dat):
+        body = json.dumps(dat)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class PronunciationServer(ThreadingMixIn, HTTPServer):
+    """ Serves a Pronouncer over HTTP. Use port 0 to pick a free port, see
+    server_address for the one it got.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, pronouncer, host='localhost', port=8000, max_batch=256, max_delay=0.005,
+                 verbose=False):
+        HTTPServer.__init__(self, (host, port), PronunciationHandler)
+        self.verbose = verbose
+        self.batcher = MicroBatcher(pronouncer, max_batch, max_delay)
+        self.batcher.start()
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.batcher.stop()
+
+
+def pronounce_remote(words, host='localhost', port=8000, timeout=30):
+    """ Asks a running PronunciationServer for the pronunciations of a list
+    of words. Returns a list of (word, pronunciation) pairs.
+    """
+    url = 'http://%s:%d/pronounce' % (host, port)
+    reply = urllib2.urlopen(url, '\n'.join(words), timeout)
+    return [(r['word'], r['pronunciation']) for r in json.load(reply)['pronunciations']]
+
+def remote_stats(host='localhost', port=8000, timeout=30):
+    """ Fetches the /stats of a running PronunciationServer. """
+    return json.load(urllib2.urlopen('http://%s:%d/stats' % (host, port), timeout=timeout))
@@ -0,0 +1,160 @@
+"""
+    TrainingMonitor
+
+    Hooks into NeuralNet training to see where the time goes. A monitor is
+    passed to NeuralNet.train() or train_stream() and is told when training
+    begins and ends, when each epoch begins and ends, and after every batch.
+
+    Its timer adds up the time spent in each phase of training:
+
+        - sampling: picking, stacking or streaming in the training batches.
+        - forward: running the batches through the net.
+        - backward: propagating the errors back and working out gradients
+          (or 'backprop' for the one sample at a time mode, and 'gradients'
+          when ParallelTrainer's workers do it).
+        - update: applying the gradients to the weights.
+        - validation: scoring the epoch on the validation samples.
+
+    and can run a cProfile profiler during some of them.
+
+    TrainingLog writes every event as a line of JSON, for production jobs:
+
+        {"event": "epoch", "epoch": 3, "rmse": 0.13, "samples_per_s": 51234.1,
+         "learning_rate": 0.1, "phases": {"forward": 0.41, ...}, ...}
+"""
+
+import json
+import sys
+import time
+from collections import defaultdict
+
+PROFILE_PHASES = ['forward', 'backward', 'backprop', 'gradients', 'update', 'validation']
+
+class _Phase(object):
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.profile = self.timer.profiler is not None and self.name in self.timer.profile_phases
+        if self.profile:
+            self.timer.profiler.enable()
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        self.timer.totals[self.name] += time.time() - self.start
+        if self.profile:
+            self.timer.profiler.disable()
+
+
+class PhaseTimer(object):
+    """ Adds up the time spent in named phases, timed with
+
+        with timer('forward'):
+            ...
+
+    With a cProfile.Profile, it is enabled during the profile_phases only.
+    """
+
+    def __init__(self, profiler=None, profile_phases=PROFILE_PHASES):
+        self.profiler = profiler
+        self.profile_phases = set(profile_phases)
+        self.totals = defaultdict(float)
+
+    def __call__(self, name):
+        return _Phase(self, name)
+
+    def reset(self):
+        """ Returns the totals so far, in seconds, and starts over. """
+        totals = dict(self.totals)
+        self.totals.clear()
+        return totals
+
+
+class TrainingMonitor(object):
+    """ Does nothing with the training events; subclass it and override the
+    ones you need.
+    """
+
+    def __init__(self, profiler=None, profile_phases=PROFILE_PHASES):
+        self.timer = PhaseTimer(profiler, profile_phases)
+
+    def on_train_begin(self, nn, info):
+        pass
+
+    def on_epoch_begin(self, epoch):
+        pass
+
+    def on_batch_end(self, batch, num_samples, seconds):
+        pass
+
+    def on_epoch_end(self, epoch, stats):
+        """ stats holds the epoch's rmse, misclassified, samples, seconds,
+        samples_per_s, learning_rate, best_rmse and its phase timings.
+        """
+        pass
+
+    def on_train_end(self, stats):
+        pass
+
+
+class TrainingLog(TrainingMonitor):
+    """ Writes the training events to a file (or stream) as JSON lines, with
+    every batch too if batches is set. With profile_file, the profile_phases
+    are run under cProfile and its stats are dumped there at the end, with
+    the slowest functions also going into the log.
+    """
+
+    def __init__(self, out=None, batches=False, profile_file=None, profile_phases=PROFILE_PHASES):
+        profiler = None
+        if profile_file is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+        TrainingMonitor.__init__(self, profiler, profile_phases)
+        self.profile_file = profile_file
+        self.batches = batches
+        self._close = isinstance(out, basestring)
+        self.out = open(out, 'a') if self._close else out
+        self.epoch = None
+
+    def log(self, event, **fields):
+        if self.out is None:
+            return
+        fields['event'] = event
+        fields['time'] = time.time()
+        self.out.write(json.dumps(fields, sort_keys=True) + '\n')
+        self.out.flush()
+
+    def on_train_begin(self, nn, info):
+        self.log('train_begin', structure=nn.structure, learning_rate=nn.lr, **info)
+
+    def on_epoch_begin(self, epoch):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, num_samples, seconds):
+        if self.batches:
+            self.log('batch', epoch=self.epoch, batch=batch, samples=num_samples, seconds=seconds,
+                     samples_per_s=num_samples / max(seconds, 1e-9))
+
+    def on_epoch_end(self, epoch, stats):
+        self.log('epoch', **stats)
+
+    def on_train_end(self, stats):
+        if self.timer.profiler is not None:
+            self.timer.profiler.dump_stats(self.profile_file)
+            stats = dict(stats, profile_file=self.profile_file, profile_top=self._top_functions())
+        self.log('train_end', **stats)
+
+    def _top_functions(self, limit=15):
+        """ The functions with the most cumulative time in the profile. """
+        import pstats
+        entries = pstats.Stats(self.timer.profiler, stream=sys.stderr).stats
+        rows = sorted(entries.items(), key=lambda e: e[1][3], reverse=True)[:limit]
+        return [{'function': '%s:%d(%s)' % func, 'calls': calls, 'total_s': total, 'cumulative_s': cumulative}
+                for func, (_, calls, total, cumulative, _) in rows]
+
+    def close(self):
+        if self._close and self.out is not None:
+            self.out.close()
+            self.out = None
@@ -0,0 +1,97 @@
+"""
+    TrainingScheduler
+
+    Decides, after every epoch of NeuralNet training, what the learning rate
+    of the next one is and whether to stop, from the validation RMSE:
+
+        - learning_rate: the learning rate to start from, default is the
+          net's own.
+        - decay: the learning rate is multiplied by this after every epoch.
+        - plateau: after this many epochs without a new best RMSE, the
+          learning rate is multiplied by plateau_factor (0 is off).
+        - min_lr: the learning rate never goes below this.
+        - patience: training stops after this many epochs without a new
+          best RMSE.
+        - min_delta: how much lower than the best RMSE so far an epoch's has
+          to be to count as a new best for plateau and patience.
+        - target_rmse: training stops as soon as the RMSE reaches this.
+
+    With a checkpoint file, the net is saved there whenever it reaches a new
+    best RMSE, so a long run that is killed still leaves its best net
+    behind. The file is written next to it first and renamed over it, so a
+    kill mid-save leaves the last checkpoint whole.
+
+    The defaults keep the learning rate fixed and stop after 50 epochs
+    without improving, as training always has.
+"""
+
+import os
+
+class TrainingScheduler(object):
+
+    def __init__(self, patience=50, decay=1.0, plateau=0, plateau_factor=0.5, min_lr=0.0,
+                 target_rmse=None, checkpoint_file=None, learning_rate=None, min_delta=0.0):
+        self.learning_rate = learning_rate
+        self.patience = patience
+        self.min_delta = min_delta
+        self.decay = decay
+        self.plateau = plateau
+        self.plateau_factor = plateau_factor
+        self.min_lr = min_lr
+        self.target_rmse = target_rmse
+        self.checkpoint_file = checkpoint_file
+        self.pcas = None
+        self.phones = None
+        self.checkpoints = 0
+
+    def set_model(self, pcas, phones):
+        """ The PCA basis and phones to save checkpoints of the net with. """
+        self.pcas = pcas
+        self.phones = phones
+
+    def on_train_begin(self, nn):
+        if self.learning_rate is not None:
+            nn.lr = self.learning_rate
+        self.initial_lr = nn.lr
+        self.best_rmse = float('inf')
+        self.epochs_since_best = 0
+        self.epochs_since_change = 0
+
+    def on_epoch_end(self, nn, rmse, improved):
+        """ Updates nn.lr after an epoch, checkpointing the net if the epoch
+        improved on the best RMSE. Returns why to stop ('patience' or
+        'target'), or None to go on.
+        """
+        if improved:
+            self.checkpoint(nn)
+        if rmse < self.best_rmse - self.min_delta:
+            self.best_rmse = rmse
+            self.epochs_since_best = 0
+            self.epochs_since_change = 0
+        else:
+            self.epochs_since_best += 1
+            self.epochs_since_change += 1
+
+        lr = nn.lr * self.decay
+        if self.plateau and self.epochs_since_change >= self.plateau:
+            lr *= self.plateau_factor
+            self.epochs_since_change = 0
+        nn.lr = max(lr, self.min_lr)
+
+        if self.target_rmse is not None and rmse <= self.target_rmse:
+            return 'target'
+        if self.epochs_since_best > self.patience:
+            return 'patience'
+        return None
+
+    def on_train_end(self, nn):
+        """ Puts the net's learning rate back to the one training started with. """
+        nn.lr = self.initial_lr
+
+    def checkpoint(self, nn):
+        if self.checkpoint_file is None:
+            return
+        tmpname = self.checkpoint_file + '.tmp'
+        if nn.save(self.pcas, self.phones, tmpname, self.checkpoint_file.endswith('.nnb')):
+            os.rename(tmpname, self.checkpoint_file)
+            self.checkpoints += 1
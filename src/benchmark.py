@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+    A reproducible benchmark suite, so performance can be compared across
+    commits without a real dataset.
+
+    It writes a synthetic aligned lexicon in the PhonemeDataFile format, or
+    uses the one given, then measures:
+
+        - parse: reading the words and pronunciations with PhonemeDataFile.
+        - encode: turning every character into its feature columns.
+        - epoch: one epoch of mini-batch training.
+        - single: pronouncing one word at a time (latency percentiles).
+        - batch: pronouncing blocks of words at a time.
+        - memory: peak resident memory after each stage, and sizes.
+
+    Results go to a JSON file. Passing an earlier results file with
+    --compare prints how each throughput changed.
+
+        ./benchmark.py -n 20000 -o bench.json
+        ./benchmark.py -n 20000 -o bench2.json --compare bench.json
+"""
+
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+CONSONANTS = 'bcdfghjklmnpqrstvwxyz'
+VOWELS = 'aeiou'
+
+def _phone(word, i):
+    """ A made up, but context dependent and so learnable, pronunciation of
+    character i of a word, in the style of the PMTools alignments.
+    """
+    c = word[i]
+    nxt = word[i + 1] if i + 1 < len(word) else '$'
+    prev = word[i - 1] if i else '^'
+    if c == 'e' and i == len(word) - 1 and i > 1:
+        return '#'
+    if c in VOWELS:
+        if nxt in VOWELS:
+            return c.upper()
+        if i + 2 < len(word) and word[i + 2] == 'e' and nxt not in VOWELS:
+            return c.upper() + ':'
+        return c
+    if c == 'c':
+        return 's' if nxt in 'eiy' else 'k'
+    if c == 'x':
+        return '_k_s_'
+    if c == 'h' and prev in 'cst':
+        return '#'
+    if c == prev:
+        return '#'
+    return c
+
+def generate_lexicon(filename, num_words, seed=0, min_length=2, max_length=10):
+    """ Writes num_words random words and their pronunciations to filename,
+    the same ones every time for the same seed.
+    """
+    rng = random.Random(seed)
+    with open(filename, 'w') as f:
+        for _ in range(num_words):
+            length = rng.randint(min_length, max_length)
+            word = []
+            for i in range(length):
+                pool = VOWELS if rng.random() < 0.4 else CONSONANTS
+                word.append(rng.choice(pool))
+            f.write(' '.join(word) + '\n')
+            f.write(' '.join(_phone(word, i) for i in range(len(word))) + '\n')
+
+def peak_memory_mb():
+    """ The peak resident memory of this process so far, in MB. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def percentiles(times, points=(0.5, 0.9, 0.99)):
+    times = sorted(times)
+    return dict(('p%d_ms' % round(p * 100), times[min(len(times) - 1, int(p * len(times)))] * 1000)
+                for p in points)
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_parse(datafile):
+    from PhonemeDataFile import PhonemeDataFile
+    start = time.time()
+    words = list(PhonemeDataFile(datafile).readWordSplit())
+    elapsed = time.time() - start
+    return words, {'seconds': elapsed, 'words': len(words), 'words_per_s': len(words) / elapsed,
+                   'lines_per_s': 2 * len(words) / elapsed}
+
+def bench_encode(words):
+    from FeatureGenerator import FeatureGenerator
+    from numpy import concatenate
+    fgen = FeatureGenerator(None)
+    start = time.time()
+    indices = concatenate([fgen.word_indices(w) for w, _ in words])
+    elapsed = time.time() - start
+    return indices, {'seconds': elapsed, 'chars': len(indices), 'chars_per_s': len(indices) / elapsed}
+
+def bench_epoch(words, indices, hidden, batch_size, seed):
+    from FeatureGenerator import FeatureGenerator
+    from network import NeuralNet
+    from numpy import array, eye
+    from numpy.random import seed as np_seed
+    np_seed(seed)
+    phones = sorted(set(p for _, pron in words for p in pron))
+    index = dict((p, i) for i, p in enumerate(phones))
+    labels = array([index[p] for w, pron in words for p in pron[:len(w)]])
+    encoder = FeatureGenerator(None).encoder
+    truths = eye(len(phones))
+
+    nn = NeuralNet((encoder.width, hidden, len(phones)))
+    start = time.time()
+    for i in range(0, len(indices), batch_size):
+        nn.backprop_batch(encoder.dense(indices[i:i + batch_size], float), truths[labels[i:i + batch_size]])
+    elapsed = time.time() - start
+    return nn, phones, {'seconds': elapsed, 'samples': len(indices), 'samples_per_s': len(indices) / elapsed,
+                        'batch_size': batch_size, 'structure': nn.structure}
+
+def bench_single(pronouncer, words, num_words):
+    times = []
+    for w, _ in words[:num_words]:
+        start = time.time()
+        pronouncer.pronounce([w])
+        times.append(time.time() - start)
+    result = {'words': len(times), 'words_per_s': len(times) / sum(times)}
+    result.update(percentiles(times))
+    return result
+
+def bench_batch(pronouncer, words, block_size):
+    chars = [w for w, _ in words]
+    times = []
+    for i in range(0, len(chars), block_size):
+        start = time.time()
+        pronouncer.pronounce(chars[i:i + block_size])
+        times.append(time.time() - start)
+    result = {'words': len(chars), 'block_size': block_size, 'words_per_s': len(chars) / sum(times)}
+    result.update(percentiles(times))
+    return result
+
+def run_benchmarks(num_words=20000, seed=0, hidden=100, batch_size=256, block_size=1024, single_words=2000,
+                   datafile=None):
+    """ Runs every benchmark, on datafile or on a synthetic lexicon of
+    num_words words. Returns the results as a dictionary.
+    """
+    import numpy
+    from Pronouncer import Pronouncer
+
+    results = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'config': {'num_words': num_words, 'seed': seed, 'hidden': hidden, 'batch_size': batch_size,
+                   'block_size': block_size, 'single_words': single_words, 'datafile': datafile},
+        'memory': {'start_mb': peak_memory_mb()},
+    }
+    generated = datafile is None
+    if generated:
+        fd, datafile = tempfile.mkstemp('.dat', 'benchmark')
+        os.close(fd)
+        start = time.time()
+        generate_lexicon(datafile, num_words, seed)
+        results['generate'] = {'seconds': time.time() - start, 'words': num_words}
+    try:
+        words, results['parse'] = bench_parse(datafile)
+    finally:
+        if generated:
+            os.remove(datafile)
+    results['memory']['parse_mb'] = peak_memory_mb()
+
+    indices, results['encode'] = bench_encode(words)
+    results['memory']['encode_mb'] = peak_memory_mb()
+
+    nn, phones, results['epoch'] = bench_epoch(words, indices, hidden, batch_size, seed)
+    results['memory']['epoch_mb'] = peak_memory_mb()
+    results['memory']['weights_bytes'] = sum(w.nbytes for w in nn.weights)
+    results['memory']['indices_bytes'] = indices.nbytes
+
+    pronouncer = Pronouncer(None, phones, nn)
+    results['single'] = bench_single(pronouncer, words, single_words)
+    results['batch'] = bench_batch(pronouncer, words, block_size)
+    results['memory']['peak_mb'] = peak_memory_mb()
+    return results
+
+THROUGHPUTS = [('parse', 'words_per_s'), ('encode', 'chars_per_s'), ('epoch', 'samples_per_s'),
+               ('single', 'words_per_s'), ('batch', 'words_per_s')]
+
+def format_results(results, baseline=None):
+    """ A table of each throughput, and its ratio to the baseline's if given. """
+    lines = []
+    for stage, key in THROUGHPUTS:
+        line = '%-8s %14.1f %s' % (stage, results[stage][key], key)
+        if baseline is not None and stage in baseline:
+            line += '  %6.2fx' % (results[stage][key] / baseline[stage][key])
+        lines.append(line)
+    lines.append('%-8s %14.4f p50_ms' % ('single', results['single']['p50_ms']))
+    lines.append('%-8s %14.1f peak_mb' % ('memory', results['memory']['peak_mb']))
+    return '\n'.join(lines)
+
+def gen_optparse():
+    parser = OptionParser(usage="%prog [-n N] [-d D] [-o O] [--compare C] | --generate F -n N")
+    parser.add_option('-n', '--words', dest="numwords", type="int", default=20000,
+                      help="The number of words in the synthetic lexicon, default is 20000.")
+    parser.add_option('--seed', dest="seed", type="int", default=0,
+                      help="The random seed for the lexicon and the net, default is 0.")
+    parser.add_option('-d', '--rawdata', dest="datafile",
+                      help="Benchmark on this data set instead of a synthetic one.", metavar="DAT_FILE")
+    parser.add_option('--hidden', dest="hidden", type="int", default=100,
+                      help="The number of hidden nodes of the benchmarked net, default is 100.")
+    parser.add_option('-b', '--batch', dest="batchsize", type="int", default=256,
+                      help="The training mini-batch size, default is 256.")
+    parser.add_option('--block', dest="blocksize", type="int", default=1024,
+                      help="The words per batched inference pass, default is 1024.")
+    parser.add_option('--single', dest="singlewords", type="int", default=2000,
+                      help="The number of words to pronounce one at a time, default is 2000.")
+    parser.add_option('-o', '--output', dest="outputfile", default="benchmark.json",
+                      help="Where to write the JSON results, default is benchmark.json.", metavar="JSON_FILE")
+    parser.add_option('--compare', dest="comparefile",
+                      help="Earlier JSON results to compare against.", metavar="JSON_FILE")
+    parser.add_option('--generate', dest="generatefile",
+                      help="Only write a synthetic lexicon of -n words to this file.", metavar="DAT_FILE")
+    return parser
+
+def main(opts):
+    if opts.generatefile is not None:
+        generate_lexicon(opts.generatefile, opts.numwords, opts.seed)
+        print "Wrote %d words to %s"%(opts.numwords, opts.generatefile)
+        return
+    results = run_benchmarks(opts.numwords, opts.seed, max(opts.hidden, 1), max(opts.batchsize, 1),
+                             max(opts.blocksize, 1), max(opts.singlewords, 1), opts.datafile)
+    with open(opts.outputfile, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    baseline = None
+    if opts.comparefile is not None:
+        with open(opts.comparefile) as f:
+            baseline = json.load(f)
+    print format_results(results, baseline)
+    print "Saved results to %s"%opts.outputfile
+
+
+if __name__ == "__main__":
+    options, args = gen_optparse().parse_args()
+    main(options)
@@ -0,0 +1,115 @@
+"""
+    Fine-tuning: updates a trained NeuralNet for a changed lexicon instead of
+    training a new one from scratch.
+
+    The updated lexicon is compared with the one the net was trained on (the
+    base), and only the words that are new or whose pronunciation changed
+    are trained on, along with a replay sample of the unchanged words so the
+    net doesn't forget them. Phones that the net has never seen are added as
+    new output nodes after the existing ones, so the existing phone order,
+    and every output trained for it, is kept. A PCA basis the net was
+    trained behind is kept as it is.
+"""
+
+import random
+
+from PhonemeDataFile import PhonemeDataFile
+
+def entry_key(word, pron):
+    """ A word and its pronunciation (as lists of characters) as a string. """
+    return '%s\t%s' % (' '.join(word), ' '.join(pron))
+
+def diff_lexicon(filename, base_file=None, replay=1.0, seed=0):
+    """ Splits the words of filename into the ones new or changed since
+    base_file, and a random sample of replay times as many of the unchanged
+    ones. With no base_file, every word is new. Returns (changed, replayed),
+    lists of (word, pronunciation) tuples of lists of characters.
+    """
+    base = set()
+    if base_file is not None:
+        for w, p in PhonemeDataFile(base_file).readWordSplit():
+            base.add(entry_key(w, p))
+
+    changed = []
+    num_same = 0
+    for w, p in PhonemeDataFile(filename).readWordSplit():
+        if entry_key(w, p) in base:
+            num_same += 1
+        else:
+            changed.append((w, p))
+
+    replayed = []
+    num_replay = min(int(round(replay * len(changed))), num_same)
+    if num_replay > 0:
+        picks = set(random.Random(seed).sample(xrange(num_same), num_replay))
+        same = (e for e in PhonemeDataFile(filename).readWordSplit() if entry_key(*e) in base)
+        replayed = [e for i, e in enumerate(same) if i in picks]
+    return changed, replayed
+
+def grow_phones(phones, entries):
+    """ The phones with any new ones in the entries added, in sorted order,
+    after them.
+    """
+    known = set(phones)
+    new = set(p[i] for w, p in entries for i in range(len(w))) - known
+    return list(phones) + sorted(new)
+
+def encode_entries(entries, phones, pcas=None, num_components=None):
+    """ Turns (word, pronunciation) entries into the (input, truth) samples
+    of each character, projected by the PCA basis if one is given.
+    """
+    from FeatureGenerator import FeatureGenerator, run_pca
+    from numpy import concatenate, eye
+    if not entries:
+        return []
+    fgen = FeatureGenerator(None)
+    index = dict((p, i) for i, p in enumerate(phones))
+    indices = concatenate([fgen.word_indices(w) for w, _ in entries])
+    labels = [index[p[i]] for w, p in entries for i in range(len(w))]
+    inputs = fgen.encoder.dense(indices, float)
+    if pcas is not None:
+        inputs = run_pca(inputs, pcas, num_components)
+    return zip(inputs, eye(len(phones))[labels])
+
+def fine_tune(nnfile, filename, base_file=None, replay=1.0, epochs=500, batch_size=None, momentum=0.0,
+              holdout=0.1, monitor=None, scheduler=None, seed=0):
+    """ Loads the net in nnfile and fine-tunes it on the entries of filename
+    that are new or changed since base_file, plus a replay sample of the
+    others, see diff_lexicon(). holdout of the words are kept back to test
+    on. Returns the (pcas, phones, nn) to save, or None if nothing changed.
+    """
+    from network import loadNN
+    pcas, phones, nn = loadNN(nnfile, mmap=False)
+    changed, replayed = diff_lexicon(filename, base_file, replay, seed)
+    print "New or changed words: %d, replayed words: %d"%(len(changed), len(replayed))
+    if not changed:
+        return None
+
+    phones = grow_phones(phones, changed + replayed)
+    if len(phones) > nn.num_outputs:
+        print "New phones: %s"%' '.join(phones[nn.num_outputs:])
+        nn.grow_outputs(len(phones) - nn.num_outputs)
+    if scheduler is not None:
+        scheduler.set_model(pcas, phones)
+
+    rng = random.Random(seed)
+    rng.shuffle(changed)
+    rng.shuffle(replayed)
+    split_changed = len(changed) - int(len(changed) * holdout)
+    split_replayed = len(replayed) - int(len(replayed) * holdout)
+    encode = lambda entries: encode_entries(entries, phones, pcas, nn.structure[0])
+    train = encode(changed[:split_changed] + replayed[:split_replayed])
+    test_changed = encode(changed[split_changed:])
+    test_replayed = encode(replayed[split_replayed:])
+
+    def report(when):
+        for name, test in [('changed', test_changed), ('replayed', test_replayed)]:
+            if test:
+                misclassified, rmse, _ = nn.test(test, to_print=False)
+                print "%s, %s words: misclassified %f, rmse %f"%(when, name, misclassified, rmse)
+
+    report("Before")
+    nn.train(train, test_changed + test_replayed or train, epochs, debug=True, batch_size=batch_size,
+             momentum=momentum, monitor=monitor, scheduler=scheduler)
+    report("After")
+    return pcas, phones, nn
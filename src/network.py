@@ -1,12 +1,16 @@
 """
 
 """
+import json
 import math
 import random
+import struct
 import time
-import pickle
+from itertools import count, islice
 
-from numpy import concatenate, mat, multiply, ones, power, vectorize, zeros
+from numpy import (around, array, asarray, ascontiguousarray, asmatrix, atleast_2d, bincount, clip,
+                   concatenate, dtype, exp, float32, float64, fromfile, int8, int32, mat, maximum, memmap,
+                   multiply, ones, vectorize, vstack, zeros)
 from numpy.random import rand
 
 def timef(f, *args, **kwargs):
@@ -27,6 +31,18 @@ def sigmoid(x):
     else:
         return 1 / (1 + math.exp(-1 * x))
 
+def fast_sigmoid(x):
+    """Array version of sigmoid(), saturating at the same +/-25 bounds.
+
+    Works on whole ndarrays at once; the exponent is clipped first so large
+    sums never overflow.
+    """
+    x = asarray(x, dtype=float)
+    out = 1.0 / (1.0 + exp(-clip(x, -25, 25)))
+    out[x > 25] = 1.0
+    out[x < -25] = 0.0
+    return out
+
 @vectorize
 def dsigmoid(x):
     """Calculates the derivative of the sigmoid of x."""
@@ -35,6 +51,14 @@ def dsigmoid(x):
     else:
         return math.exp(x) / (1 + math.exp(x))**2
 
+def fast_dsigmoid(x):
+    """Array version of dsigmoid(), zero outside the same +/-25 bounds."""
+    x = asarray(x, dtype=float)
+    s = 1.0 / (1.0 + exp(-clip(x, -25, 25)))
+    out = s * (1.0 - s)
+    out[abs(x) > 25] = 0.0
+    return out
+
 def class_to_truth(cls_num, num_classes):
     """Converts the class into a truth vector."""
     truth = zeros((num_classes,))
@@ -45,24 +69,114 @@ def truth_to_class(truth):
     """Converts a truth vector into the class."""
     return max((x,i) for i,x in enumerate(truth))[1]
 
+def last_argmax(x):
+    """Row-wise argmax of a 2-D array, taking the last of any ties."""
+    return x.shape[1] - 1 - x[:, ::-1].argmax(axis=1)
+
+def samples_to_arrays(samples):
+    """Stacks a list of (input, truth) samples into (inputs, truths) ndarrays."""
+    inputs = array([asarray(s[0], dtype=float).ravel() for s in samples])
+    truths = array([asarray(s[1], dtype=float).ravel() for s in samples])
+    return inputs, truths
+
+class _NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_PHASE = _NullPhase()
+
+def null_timer(name):
+    """A phase timer that times nothing, see TrainingMonitor.PhaseTimer."""
+    return _NULL_PHASE
+
 def pad(x):
     """Adds a row of 1's to the top of a vector."""
     cols = x.shape[1]
     return concatenate((mat(ones((1,cols))), x))
 
 
-def loadNN(filename):
-    """ Returns a NeuralNet that was saved to a file using NeuralNet.save() """
+NET_MAGIC = 'PHNN'
+NET_VERSION = 1
+NET_ALIGN = 64
+NET_PRELUDE = struct.Struct('<4sII')
+
+class NetFileError(Exception):
+    pass
+
+def _align(n):
+    return (n + NET_ALIGN - 1) // NET_ALIGN * NET_ALIGN
+
+def loadNN(filename, mmap=True):
+    """ Returns (pcas, phones, nn) from a file saved using NeuralNet.save().
+
+    Both the binary format and the older pickled files are read. Binary
+    weights are memory-mapped read-only unless mmap is False, so processes
+    loading the same file share them. Raises NetFileError if the file can't
+    be read.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            magic = f.read(len(NET_MAGIC))
+    except IOError as e:
+        raise NetFileError('Cannot open %s: %s' % (filename, e.strerror))
+    if magic == NET_MAGIC:
+        return _load_binary(filename, mmap)
+    return _load_pickle(filename)
+
+def _load_pickle(filename):
+    import pickle
     try:
-        pcas, phones, nn = None, None, None
-        with open(filename,'r') as f:
+        with open(filename, 'rb') as f:
             dat = pickle.load(f)
-            pcas = dat["pcas"]
-            phones = dat["phones"]
-            nn = dat["nn"]
-        return pcas,phones,nn
-    except: return None, None, None
-                
+        return dat["pcas"], dat["phones"], dat["nn"]
+    except Exception as e:
+        raise NetFileError('%s is not a NeuralNet file (%s: %s).' % (filename, type(e).__name__, e))
+
+def _load_binary(filename, mmap):
+    with open(filename, 'rb') as f:
+        prelude = f.read(NET_PRELUDE.size)
+        if len(prelude) < NET_PRELUDE.size:
+            raise NetFileError('%s is truncated.' % filename)
+        _, version, length = NET_PRELUDE.unpack(prelude)
+        if version != NET_VERSION:
+            raise NetFileError('%s has format version %d, expected %d.' % (filename, version, NET_VERSION))
+        try:
+            header = json.loads(f.read(length))
+        except ValueError:
+            raise NetFileError('%s has a corrupt header.' % filename)
+
+        base = _align(NET_PRELUDE.size + length)
+        blocks = []
+        for block in header['blocks']:
+            shape = tuple(block['shape'])
+            size = dtype(block['dtype']).itemsize
+            for n in shape:
+                size *= n
+            f.seek(0, 2)
+            if base + block['offset'] + size > f.tell():
+                raise NetFileError('%s is truncated.' % filename)
+            if mmap:
+                blocks.append(memmap(filename, dtype=block['dtype'], mode='r',
+                                     offset=base + block['offset'], shape=shape))
+            else:
+                f.seek(base + block['offset'])
+                blocks.append(fromfile(f, dtype=block['dtype'], count=size // dtype(block['dtype']).itemsize).reshape(shape))
+
+    pcas = blocks.pop(0) if header['pcas'] else None
+    phones = None if header['phones'] is None else [str(p) for p in header['phones']]
+    nn = NeuralNet.from_weights(blocks, header['learning_rate'])
+    if nn.structure != header['structure']:
+        raise NetFileError('%s has weights that do not match its structure.' % filename)
+    return pcas, phones, nn
+
+def convertNN(filename, outputfile, dtype=None):
+    """ Rewrites a pickled NeuralNet file in the binary format. """
+    pcas, phones, nn = loadNN(filename)
+    nn.save_binary(pcas, phones, outputfile, dtype)
+
 
 class NeuralNet(object):
     def __init__(self, structure, learning_rate=0.1):
@@ -70,6 +184,16 @@ class NeuralNet(object):
         self.lr = learning_rate
         self.reset_weights()
 
+    @staticmethod
+    def from_weights(weights, learning_rate=0.1):
+        """Builds a NeuralNet around existing weight matrices, one per layer,
+        each with its bias as the first row."""
+        nn = NeuralNet.__new__(NeuralNet)
+        nn.structure = [weights[0].shape[0] - 1] + [w.shape[1] for w in weights]
+        nn.lr = learning_rate
+        nn.weights = [asmatrix(w) for w in weights]
+        return nn
+
     @property
     def num_outputs(self):
         return self.structure[-1]
@@ -81,6 +205,16 @@ class NeuralNet(object):
             out = self.structure[i + 1]
             self.weights.append(mat(rand(inp + 1, out)) * 2 - 1)
 
+    def grow_outputs(self, num):
+        """Adds num output nodes after the existing ones, each starting as the
+        mean of the existing output nodes' weights. Its output can never be
+        above the best existing one's, so the net's answers are unchanged
+        until it is trained on the new outputs."""
+        last = asarray(self.weights[-1])
+        new = last.mean(axis=1)[:, None].repeat(num, axis=1)
+        self.weights[-1] = asmatrix(concatenate((last, new), axis=1))
+        self.structure[-1] += num
+
     def backprop(self, sample, return_values=False):
         input = mat(sample[0]).T
         truth = mat(sample[1]).T
@@ -110,61 +244,284 @@ class NeuralNet(object):
             return sums, outputs, errors, self.weights
        
 
-    def train(self, samples, test, epochs=500, train_size=1000, val_size=500, debug=False):
+    def backprop_batch(self, inputs, truths, momentum=0.0, velocity=None, timer=None):
+        """Mini-batch version of backprop().
+
+        Propagates the errors of a whole (N x features) batch through the
+        layers with matrix products and applies the mean adjustment once.
+        With momentum, velocity is a list holding the previous adjustment
+        for each layer and is updated in place. timer times the phases, see
+        TrainingMonitor.PhaseTimer.
+        """
+        inputs = atleast_2d(asarray(inputs, dtype=float))
+        truths = atleast_2d(asarray(truths, dtype=float))
+        self.apply_gradients(self.gradients(inputs, truths, timer), len(inputs), momentum, velocity, timer)
+
+    def gradients(self, inputs, truths, timer=None):
+        """The summed (bias row + weights) gradient of each layer for a batch.
+
+        Gradients of separate batches can be added together before being
+        applied, which is how ParallelTrainer splits a batch across workers.
+        """
+        timer = timer or null_timer
+        inputs = atleast_2d(asarray(inputs, dtype=float))
+        truths = atleast_2d(asarray(truths, dtype=float))
+
+        with timer('forward'):
+            sums, outputs = self.run_batch(inputs, verbose=True)
+        with timer('backward'):
+            layer_inputs = [inputs]
+            layer_inputs.extend(outputs[:-1])
+
+            # calculate errors at each layer, one row per sample
+            errors = [truths - outputs[-1]]
+            for bias, weights in reversed(self.layers()[1:]):
+                errors.insert(0, errors[0].dot(weights.T))
+
+            grads = []
+            for input, sum, error in zip(layer_inputs, sums, errors):
+                delta = error * fast_dsigmoid(sum)
+                grads.append(vstack((delta.sum(axis=0), input.T.dot(delta))))
+        return grads
+
+    def apply_gradients(self, grads, num, momentum=0.0, velocity=None, timer=None):
+        """Updates each set of weights by the mean of num samples' gradients."""
+        with (timer or null_timer)('update'):
+            num = float(num)
+            for i, grad in enumerate(grads):
+                adjustments = self.lr * grad / num
+                if momentum:
+                    if velocity[i] is not None:
+                        adjustments = adjustments + momentum * velocity[i]
+                    velocity[i] = adjustments
+                self.weights[i] = self.weights[i] + adjustments
+
+    def train(self, samples, test, epochs=500, train_size=1000, val_size=500, debug=False,
+              batch_size=None, momentum=0.0, step=None, monitor=None, scheduler=None):
+        """Trains the net with early stopping on a validation set.
+
+        val_size samples are held out for validation once, up front, and
+        each epoch trains on train_size samples drawn from the rest. If there
+        are fewer than train_size + val_size samples, they are split between
+        the two in that ratio instead.
+
+        With batch_size set, each epoch's training samples are stacked and
+        fed through backprop_batch() in mini-batches of that size instead
+        of one backprop() call per sample. Momentum only applies to the
+        mini-batch mode. step replaces backprop_batch(), e.g. with
+        ParallelTrainer.step. monitor is a TrainingMonitor to report to, and
+        scheduler a TrainingScheduler deciding the learning rate and when to
+        stop.
+        """
+        from TrainingMonitor import TrainingMonitor
+        monitor = monitor or TrainingMonitor()
+        timer = monitor.timer
+        step = step or self.backprop_batch
+        if train_size + val_size > len(samples):
+            split = int(float(train_size) / (train_size + val_size) * len(samples))
+            train_size, val_size = split, len(samples) - split
+
+        shuffled = random.sample(samples, len(samples))
+        cur_val = shuffled[:val_size]
+        pool = shuffled[val_size:]
+        velocity = [None] * len(self.weights)
+
+        def run_epoch():
+            with timer('sampling'):
+                cur_train = random.sample(pool, min(train_size, len(pool)))
+
+            if batch_size is None:
+                with timer('backprop'):
+                    for s in cur_train:
+                        self.backprop(s)
+            else:
+                with timer('sampling'):
+                    inputs, truths = samples_to_arrays(cur_train)
+                for num, start in enumerate(range(0, len(inputs), batch_size)):
+                    end = start + batch_size
+                    begin = time.time()
+                    step(inputs[start:end], truths[start:end], momentum, velocity, timer)
+                    monitor.on_batch_end(num, len(inputs[start:end]), time.time() - begin)
+            return len(cur_train), cur_val
+
+        return self._train_loop(run_epoch, test, epochs, debug, monitor, scheduler)
+
+    def train_stream(self, batches, val, test, epochs=500, batches_per_epoch=None, debug=False,
+                     momentum=0.0, step=None, monitor=None, scheduler=None):
+        """Trains on mini-batches streamed from batches(), with early stopping
+        on the fixed val samples.
+
+        batches() returns a fresh iterable of (inputs, truths) arrays for one
+        pass over the data, so the whole training set never has to be in
+        memory. An epoch is one pass, or batches_per_epoch batches taken from
+        a stream that restarts whenever it runs out. step, monitor and
+        scheduler are as in train().
+        """
+        from TrainingMonitor import TrainingMonitor
+        monitor = monitor or TrainingMonitor()
+        timer = monitor.timer
+        step = step or self.backprop_batch
+        velocity = [None] * len(self.weights)
+
+        def cycle():
+            while True:
+                empty = True
+                for batch in batches():
+                    empty = False
+                    yield batch
+                if empty:
+                    return
+        stream = cycle()
+
+        def run_epoch():
+            epoch = iter(batches() if batches_per_epoch is None else islice(stream, batches_per_epoch))
+            num = 0
+            for batch in count():
+                with timer('sampling'):
+                    inputs, truths = next(epoch, (None, None))
+                if inputs is None:
+                    break
+                begin = time.time()
+                step(inputs, truths, momentum, velocity, timer)
+                monitor.on_batch_end(batch, len(inputs), time.time() - begin)
+                num += len(inputs)
+            return num, val
+
+        return self._train_loop(run_epoch, test, epochs, debug, monitor, scheduler)
+
+    def _train_loop(self, run_epoch, test, epochs, debug, monitor, scheduler=None):
+        """Runs epochs until the scheduler stops them, see TrainingScheduler.
+
+        run_epoch() trains a single epoch and returns the number of samples
+        it trained on and the validation samples to score it with. The
+        weights of the best epoch are kept, and every epoch is reported to
+        the monitor. Returns the number of epochs run.
+        """
+        if scheduler is None:
+            from TrainingScheduler import TrainingScheduler
+            scheduler = TrainingScheduler()
         best_rmse = 9000000001
-        best_weights = []
-        epochs_since_best = 0
-
-        if train_size > len(samples):
-            train_size = len(samples)*0.8
-        if val_size > len(samples):
-            val_size = len(samples)*0.2
+        best_weights = list(self.weights)
+        stopped = 'epochs'
+        num_epochs = 0
+        num_trained = 0
+        train_time = 0.0
+        timer = monitor.timer
+        timer.reset()
+        scheduler.on_train_begin(self)
+        monitor.on_train_begin(self, {'epochs': epochs})
 
-        cur_set = samples
         try:
             for num_epoch in range(epochs):
-                if epochs_since_best > 50:
-                    break
-
-                if len(samples) > train_size + val_size:
-                    cur_set = random.sample(samples, train_size + val_size)
-                    cur_train = cur_set[:train_size]
-                    cur_val = cur_set[-val_size:]
-                else:
-                    split = int((float(train_size) / train_size + val_size) * len(samples))
-                    cur_set = random.sample(samples, len(samples))
-                    cur_train = cur_set[:split]
-                    cur_val = cur_set[split:]
-                for s in cur_train:
-                    self.backprop(s)
-
-                misclassified, rmse, _ = self.test(cur_val, to_print=False)
-                if rmse < best_rmse:
+                monitor.on_epoch_begin(num_epoch)
+                learning_rate = self.lr
+                start = time.time()
+                epoch_trained, cur_val = run_epoch()
+                epoch_time = time.time() - start
+                num_epochs += 1
+                num_trained += epoch_trained
+                train_time += epoch_time
+
+                with timer('validation'):
+                    misclassified, rmse, _ = self.test(cur_val, to_print=False)
+                improved = rmse < best_rmse
+                if improved:
                     best_rmse = rmse
                     best_weights = list(self.weights)
-                    epochs_since_best = 0
-                else:
-                    epochs_since_best += 1
+                stop = scheduler.on_epoch_end(self, rmse, improved)
 
                 if debug:
-                    print('Epoch %d, \tRMSE: %f' % (num_epoch, rmse))        
+                    print('Epoch %d, \tRMSE: %f, \t%.1f samples/s' %
+                          (num_epoch, rmse, epoch_trained / max(epoch_time, 1e-9)))
+                monitor.on_epoch_end(num_epoch, {
+                    'epoch': num_epoch,
+                    'rmse': rmse,
+                    'misclassified': misclassified,
+                    'best_rmse': best_rmse,
+                    'samples': epoch_trained,
+                    'seconds': epoch_time,
+                    'samples_per_s': epoch_trained / max(epoch_time, 1e-9),
+                    'learning_rate': learning_rate,
+                    'phases': timer.reset(),
+                })
+                if stop is not None:
+                    stopped = stop
+                    break
         except KeyboardInterrupt:
-            pass
+            stopped = 'interrupted'
         self.weights = best_weights
+        scheduler.on_train_end(self)
 
         print('\n---Final Results:---')
-        print('epochs: %d' % (num_epoch - 1))
-        self.test(test)
-
-
-    def save(self, pcas, phones, filename):
+        print('epochs: %d (stopped by %s)' % (num_epochs, stopped))
+        print('throughput: %.1f samples/s' % (num_trained / max(train_time, 1e-9)))
+        misclassified, rmse, _ = self.test(test)
+        monitor.on_train_end({
+            'epochs': num_epochs,
+            'best_rmse': best_rmse,
+            'test_rmse': rmse,
+            'test_misclassified': misclassified,
+            'stopped': stopped,
+            'samples': num_trained,
+            'seconds': train_time,
+            'samples_per_s': num_trained / max(train_time, 1e-9),
+        })
+        return num_epochs
+
+
+    def save(self, pcas, phones, filename, binary=None):
+        """Saves the net with its phones and PCA basis, returning whether it
+        worked. Files ending in .nnb (or with binary set) are written in the
+        binary format, everything else is pickled."""
+        if binary is None:
+            binary = filename.endswith('.nnb')
         try:
-            with open(filename,'w') as f:
-                dat = {"nn":self,"phones":phones,"pcas":pcas}
-                pickle.dump(dat,f)
+            if binary:
+                self.save_binary(pcas, phones, filename)
+            else:
+                import pickle
+                with open(filename,'wb') as f:
+                    dat = {"nn":self,"phones":phones,"pcas":pcas}
+                    pickle.dump(dat,f)
             return True
         except: return False   
 
+    def save_binary(self, pcas, phones, filename, dtype=None):
+        """Writes the net in the binary format read by loadNN().
+
+        The file is 'PHNN' <version:uint32> <header length:uint32>, a JSON
+        header with the structure, learning rate and phones, then the PCA
+        basis (if any) and each layer's weights as raw blocks aligned to 64
+        bytes, so they can be memory-mapped. dtype defaults to the weights'.
+        """
+        blocks = [] if pcas is None else [asarray(pcas, dtype=dtype or float)]
+        blocks.extend(asarray(w, dtype=dtype or w.dtype) for w in self.weights)
+
+        layout = []
+        offset = 0
+        for block in blocks:
+            layout.append({'offset': offset, 'dtype': block.dtype.str, 'shape': list(block.shape)})
+            offset = _align(offset + block.nbytes)
+        header = json.dumps({
+            'structure': self.structure,
+            'learning_rate': self.lr,
+            'phones': phones,
+            'pcas': pcas is not None,
+            'blocks': layout,
+        }, sort_keys=True)
+
+        with open(filename, 'wb') as f:
+            f.write(NET_PRELUDE.pack(NET_MAGIC, NET_VERSION, len(header)))
+            f.write(header)
+            base = _align(f.tell())
+            for block, info in zip(blocks, layout):
+                f.write('\0' * (base + info['offset'] - f.tell()))
+                f.write(block.tostring())
+
+    def compile(self, precision='float32'):
+        """Returns an inference-only CompiledNet of this net."""
+        return CompiledNet(self, precision)
+
     def run(self, input, verbose=False):
 
         # if input is a tuple, it is (input, output) - we want input only
@@ -186,27 +543,91 @@ class NeuralNet(object):
         else:
             return output
 
-    def test(self, samples, to_print=True):
-        error_sum = 0
-        num_miss = 0
-        confusion = [[0] * self.num_outputs for _ in range(self.num_outputs)]
-        for s in samples:
-            input = s[0]
-            truth = s[1]
-
-            output = self.run(input)
+    def layers(self):
+        """Returns a (bias, weights) pair of ndarray views for each layer.
+
+        The bias is the first row of each weight matrix (the row pad() lines
+        up with its row of 1's), so splitting it off costs nothing.
+        """
+        return [(asarray(w)[0], asarray(w)[1:]) for w in self.weights]
+
+    def run_batch(self, inputs, verbose=False):
+        """Runs many samples through the net at once.
+
+        Takes an (N x features) array and returns an (N x outputs) array,
+        row i matching run() on sample i.
+        """
+        inputs = atleast_2d(asarray(inputs, dtype=float))
+        layers = self.layers()
+        bias, weights = layers[0]
+        return self._forward(inputs.dot(weights) + bias, layers[1:], verbose)
+
+    def run_indices(self, indices, verbose=False):
+        """Runs many one-hot samples through the net, given as the (N x k)
+        active columns of each sample (see FeatureGenerator.FeatureEncoder).
+
+        The first layer becomes a gather-and-sum of k weight rows per sample
+        instead of a dot product over every input column.
+        """
+        indices = atleast_2d(asarray(indices))
+        layers = self.layers()
+        bias, weights = layers[0]
+        return self._forward(weights[indices].sum(axis=1) + bias, layers[1:], verbose)
+
+    def _forward(self, sum, layers, verbose):
+        """Finishes a batched pass given the first layer's sums."""
+        output = fast_sigmoid(sum)
+        sums = [sum]
+        outputs = [output]
+
+        for bias, weights in layers:
+            sum = output.dot(weights) + bias
+            output = fast_sigmoid(sum)
+            sums.append(sum)
+            outputs.append(output)
 
-            o = truth_to_class(output)
-            t = truth_to_class(truth)
-            confusion[o][t] += 1
-            if o != t:
-                num_miss += 1
+        if verbose:
+            return sums, outputs
+        else:
+            return output
 
-            error = power(truth - output.T, 2).sum() / len(truth)
-            error_sum += error
+    def evaluate(self, samples, chunk_size=8192):
+        """Scores the net on (input, truth) samples, a chunk of samples per
+        batched pass.
+
+        Returns a dictionary of the misclassified fraction, the RMSE, the
+        (output class x truth class) confusion matrix and each class's
+        precision and recall (0 where a class is never predicted or never
+        true). Ties between outputs go to the last class, like
+        truth_to_class().
+        """
+        n = self.num_outputs
+        confusion = zeros(n * n, dtype=int)
+        error_sum = 0.0
+        for start in range(0, len(samples), chunk_size):
+            inputs, truths = samples_to_arrays(samples[start:start + chunk_size])
+            outputs = self.run_batch(inputs)
+            o = last_argmax(outputs)
+            t = last_argmax(truths)
+            confusion += bincount(o * n + t, minlength=n * n)
+            error_sum += (((truths - outputs) ** 2).sum(axis=1) / n).sum()
+        confusion = confusion.reshape(n, n)
+
+        hits = confusion.diagonal().astype(float)
+        predicted = confusion.sum(axis=1)
+        actual = confusion.sum(axis=0)
+        return {
+            'misclassified': (len(samples) - hits.sum()) / len(samples),
+            'rmse': math.sqrt(error_sum / len(samples)),
+            'confusion': confusion,
+            'precision': hits / maximum(predicted, 1),
+            'recall': hits / maximum(actual, 1),
+        }
 
-        misclassified = float(num_miss) / len(samples)
-        rmse = math.sqrt(error_sum / len(samples))
+    def test(self, samples, to_print=True):
+        results = self.evaluate(samples)
+        misclassified, rmse = results['misclassified'], results['rmse']
+        confusion = results['confusion'].tolist()
 
         if to_print:
             print('misclassified: %f' % misclassified)
@@ -214,6 +635,10 @@ class NeuralNet(object):
             if len(confusion) < 30:
                 print('confusion:')
                 print(confusion)
+                print('precision:')
+                print(results['precision'].round(4).tolist())
+                print('recall:')
+                print(results['recall'].round(4).tolist())
 
         return misclassified, rmse, confusion
 
@@ -225,3 +650,103 @@ class NeuralNet(object):
 
         print 'Total time: %f s' % (end - start)
         print 'Average time: %f ms per run' % ((end - start) / num_runs * 1000)
+
+
+PRECISIONS = ['float64', 'float32', 'int8']
+
+def compiled_sigmoid(x):
+    """fast_sigmoid() that keeps the dtype of x and works in place."""
+    out = clip(x, -25, 25)
+    out *= -1
+    exp(out, out)
+    out += 1
+    out **= -1
+    out[x > 25] = 1
+    out[x < -25] = 0
+    return out
+
+class CompiledNet(object):
+    """An inference-only copy of a NeuralNet, for throughput over exactness.
+
+    Each layer is a contiguous bias vector and weight array instead of a
+    numpy matrix. With precision 'float32' the whole pass runs in float32.
+    With 'int8' the weights are also quantized to int8 with one scale per
+    layer (the layer's largest weight maps to 127), so they take an eighth
+    of the memory. The first layer of run_indices() is then an integer
+    gather-and-sum, and later layers are dequantized as they are used.
+    """
+
+    def __init__(self, nn, precision='float32'):
+        if precision not in PRECISIONS:
+            raise ValueError('Unknown precision: %s, expected one of %s' % (precision, ', '.join(PRECISIONS)))
+        self.structure = list(nn.structure)
+        self.precision = precision
+        self.dtype = float64 if precision == 'float64' else float32
+        self.layers = []
+        for bias, weights in nn.layers():
+            scale = 1.0
+            if precision == 'int8':
+                scale = float(abs(weights).max()) / 127 or 1.0
+                weights = around(weights / scale).astype(int8)
+            else:
+                weights = asarray(weights, dtype=self.dtype)
+            self.layers.append((ascontiguousarray(bias, dtype=self.dtype), ascontiguousarray(weights),
+                                self.dtype(scale)))
+
+    @property
+    def num_outputs(self):
+        return self.structure[-1]
+
+    @property
+    def nbytes(self):
+        """The memory taken by the weights and biases."""
+        return sum(bias.nbytes + weights.nbytes for bias, weights, _ in self.layers)
+
+    def run_batch(self, inputs):
+        """Same as NeuralNet.run_batch(), in this net's precision."""
+        inputs = atleast_2d(asarray(inputs, dtype=self.dtype))
+        bias, weights, scale = self.layers[0]
+        return self._forward(self._dot(inputs, weights, scale) + bias)
+
+    def run_indices(self, indices):
+        """Same as NeuralNet.run_indices(), in this net's precision."""
+        indices = atleast_2d(asarray(indices))
+        bias, weights, scale = self.layers[0]
+        if weights.dtype == int8:
+            sum = weights[indices].sum(axis=1, dtype=int32).astype(self.dtype) * scale
+        else:
+            sum = weights[indices].sum(axis=1)
+        return self._forward(sum + bias)
+
+    def _dot(self, inputs, weights, scale):
+        if weights.dtype == int8:
+            return inputs.dot(weights.astype(self.dtype)) * scale
+        return inputs.dot(weights)
+
+    def _forward(self, sum):
+        output = compiled_sigmoid(sum)
+        for bias, weights, scale in self.layers[1:]:
+            output = compiled_sigmoid(self._dot(output, weights, scale) + bias)
+        return output
+
+def compare_outputs(reference, outputs, labels=None):
+    """Compares a batch of net outputs against reference outputs of the same
+    samples, e.g. from a CompiledNet and the float64 NeuralNet it came from.
+
+    Returns a dictionary of the largest absolute difference, the fraction of
+    samples whose best output agrees and, with the true class labels, the
+    misclassification rate of each and the change between them.
+    """
+    reference, outputs = asarray(reference, dtype=float), asarray(outputs, dtype=float)
+    best_ref, best = reference.argmax(axis=1), outputs.argmax(axis=1)
+    report = {
+        'samples': len(reference),
+        'max_abs_diff': float(abs(reference - outputs).max()) if len(reference) else 0.0,
+        'argmax_agreement': float((best_ref == best).mean()) if len(reference) else 1.0,
+    }
+    if labels is not None:
+        labels = asarray(labels)
+        report['reference_misclassified'] = float((best_ref != labels).mean())
+        report['misclassified'] = float((best != labels).mean())
+        report['misclassified_delta'] = report['misclassified'] - report['reference_misclassified']
+    return report
@@ -1,26 +1,81 @@
 #!/usr/bin/env python 
 #
 # Usage:
-#   ./phonemer.py -h | ([-s P | [-n H] [-p V]] -d D [-f F] | -t N [-w W]) 
+#   ./phonemer.py -h | ([-s P | [-n H] [-p V]] -d D [-f F] | -t N [-w W | -i I [-o O]]) 
 # 
+# Only the standard library is imported up front; each command imports the
+# modules it needs, so looking up a word never loads the training, PCA,
+# dataset or server code.
+#
 
 import os
 import sys
-import nltk
 from optparse import OptionParser
-from FeatureGenerator import FeatureGenerator
-from PhonemeDataFile import PhonemeDataFile
-from network import    NeuralNet,loadNN
-from random import shuffle
 
 def gen_optparse():
-    parser = OptionParser(usage="%prog -h | ([-s P | [-n H] [-p V]] -d D [-f F] | -t N [-w W]) ")
-    parser.add_option('-s', '--split', action="store", dest="splitsize", type="float",
-                      help="Split the raw data set into some random subsets, please give the percent as a decimal.")
+    parser = OptionParser(usage="%prog -h | ([-s P | [-n H] [-p V]] -d D [-f F] | -t N [-w W | -i I [-o O]]) ")
+    parser.add_option('-s', '--split', action="store", dest="splitsize",
+                      help="Split the raw data set into some random subsets, please give the percent as a decimal (or a list of them like 0.8,0.1,0.1).")
+    parser.add_option('--folds', action="store", dest="folds", type="int",
+                      help="Split the raw data set into the train and test files of this many folds instead.")
+    parser.add_option('--split-seed', action="store", dest="splitseed", type="int", default=0,
+                      help="The seed picking which words go to which split, default is 0.")
+    parser.add_option('--encode', action="store_true", dest="encode", default=False,
+                      help="Write the splits as dataset caches, ready to train on with -c, instead of as text.")
     parser.add_option('-n', '--hidden', action="store", dest="numhidden", default=50, type="int",
                       help="The number of hidden nodes in the neural net.")
     parser.add_option('-l', '--layers', action="store", dest="numlayers", type="int",default=1,
                       help="The number of layers in the neural net.")
+    parser.add_option('-b', '--batch', action="store", dest="batchsize", type="int",
+                      help="Train on mini-batches of this many samples instead of one at a time. Raise --learning-rate with it, roughly in proportion, e.g. -b 16 --learning-rate 1.6.")
+    parser.add_option('-m', '--momentum', action="store", dest="momentum", type="float", default=0.0,
+                      help="The momentum for mini-batch training, default is 0.")
+    parser.add_option('-c', '--cache', action="store_true", dest="cache", default=False,
+                      help="Compile the data set into a binary cache next to it (or reuse it) and work from that.")
+    parser.add_option('--stream', action="store_true", dest="stream", default=False,
+                      help="Stream the data set through training in shuffled mini-batches instead of loading it all.")
+    parser.add_option('--buffer', action="store", dest="buffersize", type="int", default=10000,
+                      help="The size of the shuffle buffer when streaming, default is 10000.")
+    parser.add_option('--epoch-batches', action="store", dest="epochbatches", type="int",
+                      help="The number of mini-batches per epoch when streaming, default is a full pass.")
+    parser.add_option('--learning-rate', dest="learningrate", type="float", default=0.1,
+                      help="The learning rate to start training with, default is 0.1.")
+    parser.add_option('--lr-decay', dest="lrdecay", type="float", default=1.0,
+                      help="Multiply the learning rate by this after every epoch, default is 1 (fixed).")
+    parser.add_option('--plateau', dest="plateau", type="int", default=0,
+                      help="Cut the learning rate after this many epochs without a better validation RMSE, default is 0 (off).")
+    parser.add_option('--plateau-factor', dest="plateaufactor", type="float", default=0.5,
+                      help="What to multiply the learning rate by on a --plateau, default is 0.5.")
+    parser.add_option('--min-lr', dest="minlr", type="float", default=0.0,
+                      help="The lowest the learning rate can be decayed or cut to, default is 0.")
+    parser.add_option('--patience', dest="patience", type="int", default=50,
+                      help="Stop training after this many epochs without a better validation RMSE, default is 50.")
+    parser.add_option('--min-delta', dest="mindelta", type="float", default=0.0,
+                      help="How much the validation RMSE has to improve by to count for --patience and --plateau, default is 0.")
+    parser.add_option('--target-rmse', dest="targetrmse", type="float",
+                      help="Stop training as soon as the validation RMSE reaches this.")
+    parser.add_option('--checkpoint', action="store_true", dest="checkpoint", default=False,
+                      help="Save the net to -f every time it reaches a new best validation RMSE, not just at the end.")
+    parser.add_option('--log', dest="logfile",
+                      help="Append a JSON line per training epoch to this file, with the time spent in each phase.", metavar="LOG_FILE")
+    parser.add_option('--log-batches', action="store_true", dest="logbatches", default=False,
+                      help="Also log every mini-batch with --log.")
+    parser.add_option('--profile', dest="profilefile",
+                      help="Run cProfile over the forward, backward, update and validation phases of training and save its stats here.", metavar="PROF_FILE")
+    parser.add_option('--finetune', dest="finetune",
+                      help="Fine-tune this trained neural net on the new and changed words of -d instead of training from scratch, saving it to -f.", metavar="NN_FILE")
+    parser.add_option('--base', dest="basefile",
+                      help="The data set the --finetune net was trained on; only words new or changed since it are trained on.", metavar="DAT_FILE")
+    parser.add_option('--replay', dest="replay", type="float", default=1.0,
+                      help="With --finetune, also train on this many unchanged words per new one, default is 1.")
+    parser.add_option('--sweep', dest="sweep",
+                      help="Train one neural net per setting of a grid like 'hidden=50,100;layers=1,2;pca=0,40' (or a JSON file of one) and keep the best.", metavar="GRID")
+    parser.add_option('--sweep-random', dest="sweepsamples", type="int",
+                      help="Only train this many settings of the sweep grid, picked at random.")
+    parser.add_option('--sweep-results', dest="sweepresults", default="sweep_results.tsv",
+                      help="Where to write the table of sweep results, default is sweep_results.tsv.", metavar="TSV_FILE")
+    parser.add_option('--epochs', dest="epochs", type="int", default=500,
+                      help="The most epochs to train a neural net (or each net of a sweep) for, default is 500.")
     parser.add_option('-p', '--pca', dest="pca", type="int",
                       help="The number of PCA vectors")
     parser.add_option('-t', '--trained', dest="nnfile",
@@ -29,11 +84,54 @@ def gen_optparse():
                       help="The raw training file to train the Neural net and save it to a file.", metavar="DAT_FILE")
     parser.add_option('-f', '--savefile', dest='savefile',default="savedweights.nn",
                       help="The optional output name for a trained neural net file.", metavar="NN_FILE")
+    parser.add_option('--convert', dest='convertfile',
+                      help="Convert the trained neural net file to the binary .nnb format.", metavar="NN_FILE")
     parser.add_option('-w', '--word', dest="word",
                       help="The word to get the phoneme list for.", metavar="WORD")
+    parser.add_option('-i', '--input', dest="inputfile",
+                      help="A file of words to pronounce, one per line, or - for stdin.", metavar="WORD_FILE")
+    parser.add_option('-o', '--output', dest="outputfile",
+                      help="Where to write the pronunciations of -i, default is stdout.", metavar="OUT_FILE")
+    parser.add_option('--format', dest="format", default="tsv",
+                      help="The output format for -i: tsv, chars or json, default is tsv.")
+    parser.add_option('--block', dest="blocksize", type="int", default=1024,
+                      help="The number of words per batched pass for -i, default is 1024.")
+    parser.add_option('--word-cache', dest="cachesize", type="int", default=0,
+                      help="Cache the pronunciations of this many recent words, default is 0 (off).")
+    parser.add_option('--word-cache-file', dest="cachefile",
+                      help="Warm-start the word cache from this file and save it back afterwards.", metavar="CACHE_FILE")
+    parser.add_option('--window-cache', dest="windowcache", type="int", default=0,
+                      help="Cache the net outputs of this many character windows for -i, -1 to precompute all of them, default is 0 (off).")
+    parser.add_option('--beam', dest="beam", type="int", default=0,
+                      help="Decode whole words with a beam search of this width instead of each character's best phone, default is 0 (off).")
+    parser.add_option('--topk', dest="topk", type="int", default=1,
+                      help="With -w, print this many of the best pronunciations found by a beam search at least this wide (or each character's best phones in a lookup table); with --export-table, keep this many phones per window. Default is 1.")
+    parser.add_option('--bigram', dest="bigramfile",
+                      help="Score the beam search with the phone bigrams of this data set.", metavar="DAT_FILE")
+    parser.add_option('--precision', dest="precision",
+                      help="Run the trained neural net in float64, float32 or int8 for speed over exactness, default is the net as saved.")
+    parser.add_option('--compare', dest="comparefile",
+                      help="Report how the outputs of --precision differ from float64 on the words of this data set.", metavar="DAT_FILE")
+    parser.add_option('--export-table', dest="tablefile",
+                      help="Run every character window through the trained neural net and save the best phones of each as a lookup table, which -t then takes in place of the net for -w and -i.", metavar="TABLE_FILE")
+    parser.add_option('--serve', dest="port", type="int",
+                      help="Serve pronunciations of the trained neural net over HTTP on this port.")
+    parser.add_option('--host', dest="host", default="localhost",
+                      help="The host to serve on, default is localhost.")
+    parser.add_option('--max-batch', dest="maxbatch", type="int", default=256,
+                      help="The most words the server runs through the net at once, default is 256.")
+    parser.add_option('--max-delay', dest="maxdelay", type="float", default=5.0,
+                      help="The most milliseconds a server request waits for others to batch with, default is 5.")
+    parser.add_option('-j', '--jobs', dest="jobs", type="int", default=1,
+                      help="The number of worker processes for -i, --sweep and mini-batch training, 0 for one per core, default is 1.")
     return parser
 
-def makeNN(filename, outputfile, hidden, pca, layers):
+def makeNN(filename, outputfile, hidden, pca, layers, batchsize=None, momentum=0.0, jobs=1, monitor=None,
+           scheduler=None, epochs=500):
+    from FeatureGenerator import FeatureGenerator
+    from PhonemeDataFile import PhonemeDataFile
+    from network import NeuralNet
+    from random import shuffle
     fgen = FeatureGenerator(PhonemeDataFile(filename))
     features, pcas = list(fgen.features_vector(pca))
     shuffle(features)
@@ -48,66 +146,361 @@ def makeNN(filename, outputfile, hidden, pca, layers):
     print "len(train)=%d, len(test)=%d"%(len(train),len(test))
 
     network = NeuralNet( inputVars )
-    network.train(train, test, debug=True)
+    if scheduler is not None: scheduler.set_model( pcas, list(fgen.phones) )
+    if jobs == 1 or batchsize is None:
+        network.train(train, test, epochs, debug=True, batch_size=batchsize, momentum=momentum, monitor=monitor,
+                      scheduler=scheduler)
+    else:
+        from ParallelTrainer import ParallelTrainer
+        with ParallelTrainer( network, jobs, batchsize ) as trainer:
+            print "Training across %d workers."%trainer.workers
+            network.train(train, test, epochs, debug=True, batch_size=batchsize, momentum=momentum,
+                          step=trainer.step, monitor=monitor, scheduler=scheduler)
     if network.save(pcas,list(fgen.phones),outputfile):
         print "Saved nn successfully"
     else: print "Error while saving nn"
 
 
+def makeNNStream(filename, outputfile, hidden, pca, layers, batchsize, momentum, buffersize,
+                 epochbatches=None, jobs=1, monitor=None, scheduler=None, holdout=0.2, valsize=1000,
+                 testsize=10000, epochs=500):
+    from FeatureGenerator import FeatureGenerator, gen_pca_stream, run_pca
+    from PhonemeDataFile import PhonemeDataFile
+    fgen = FeatureGenerator(PhonemeDataFile(filename))
+    phones = fgen.gen_phone_inventory()
+    print "Phones: %d"%len(phones)
+
+    pcas = None
+    project = lambda x: x
+    if pca:
+        _, pcas = gen_pca_stream(x for x, _ in fgen.encoded_batches(phones, 1 << 14, holdout=holdout, dense=True))
+        project = lambda x: run_pca(x, pcas, pca)
+
+    heldout = []
+    for inputs, truths in fgen.encoded_batches(phones, batchsize, holdout=holdout, part='test', dense=True):
+        heldout.extend(zip(project(inputs), truths))
+        if len(heldout) >= valsize + testsize: break
+
+    def batches():
+        return ((project(x), t) for x, t in fgen.encoded_batches(phones, batchsize, buffersize,
+                                                                holdout=holdout, dense=True))
+
+    trainStreamed(batches, heldout[:valsize], heldout[valsize:valsize + testsize],
+                  pca or fgen.encoder.width, pcas, phones, outputfile, hidden, layers, batchsize, momentum,
+                  epochbatches, jobs, monitor, scheduler, epochs)
+
+def makeNNCached(filename, outputfile, hidden, pca, layers, batchsize, momentum,
+                 epochbatches=None, jobs=1, monitor=None, scheduler=None, holdout=0.2, valsize=1000,
+                 testsize=10000, epochs=500):
+    from DatasetCache import DatasetCache
+    from FeatureGenerator import gen_pca_stream, run_pca
+    cache = DatasetCache.open(filename)
+    print "Loaded cache: %s"%cache.filename
+    print "Phones: %d"%len(cache.phones)
+
+    heldout = cache.sample_mask(cache.word_mask(holdout))
+    rows = heldout.nonzero()[0][:valsize + testsize]
+    inputs, truths = cache.inputs(rows), cache.truths(rows)
+
+    pcas = None
+    project = lambda x: x
+    if pca:
+        _, pcas = gen_pca_stream(x for x, _ in cache.batches(1 << 14, ~heldout, shuffle=False))
+        project = lambda x: run_pca(x, pcas, pca)
+    samples = zip(project(inputs), truths)
+
+    def batches():
+        return ((project(x), t) for x, t in cache.batches(batchsize, ~heldout))
+
+    trainStreamed(batches, samples[:valsize], samples[valsize:], pca or cache.width,
+                  pcas, cache.phones, outputfile, hidden, layers, batchsize, momentum, epochbatches, jobs,
+                  monitor, scheduler, epochs)
+
+def trainStreamed(batches, val, test, num_input, pcas, phones, outputfile, hidden, layers,
+                  batchsize, momentum, epochbatches, jobs=1, monitor=None, scheduler=None, epochs=500):
+    from network import NeuralNet
+    inputVars = tuple([num_input] + [hidden]*layers + [len(phones)])
+    print "Making NN with: %s"%str(inputVars)
+    print "len(val)=%d, len(test)=%d"%(len(val),len(test))
+
+    network = NeuralNet( inputVars )
+    if scheduler is not None: scheduler.set_model( pcas, phones )
+    if jobs == 1:
+        network.train_stream(batches, val, test, epochs, batches_per_epoch=epochbatches, debug=True, momentum=momentum,
+                             monitor=monitor, scheduler=scheduler)
+    else:
+        from ParallelTrainer import ParallelTrainer
+        with ParallelTrainer( network, jobs, batchsize ) as trainer:
+            print "Training across %d workers."%trainer.workers
+            network.train_stream(batches, val, test, epochs, batches_per_epoch=epochbatches, debug=True,
+                                 momentum=momentum, step=trainer.step, monitor=monitor, scheduler=scheduler)
+    if network.save(pcas,phones,outputfile):
+        print "Saved nn successfully"
+    else: print "Error while saving nn"
+
+
+def fineTuneNN( nnfile, filename, basefile, outputfile, replay, epochs, batchsize, momentum, monitor=None,
+                scheduler=None ):
+    from finetune import fine_tune
+    from network import NetFileError
+    try:
+        tuned = fine_tune( nnfile, filename, basefile, replay, epochs, batchsize, momentum,
+                           monitor=monitor, scheduler=scheduler )
+    except NetFileError as e:
+        print "Could not load NeuralNet file: %s"%e
+        return
+    if tuned is None:
+        print "Nothing new to fine-tune on."
+        return
+    pcas, phones, network = tuned
+    if network.save(pcas,phones,outputfile):
+        print "Saved nn successfully"
+    else: print "Error while saving nn"
+
+def sweepNN( filename, spec, samples, outputfile, resultsfile, jobs, batchsize, momentum, epochs,
+             epochbatches, scheduler=None ):
+    from sweep import format_results, grid_configs, parse_grid, run_sweep
+    try:
+        configs = grid_configs( parse_grid(spec), samples )
+    except ValueError as e:
+        print "Invalid sweep: %s"%e
+        return
+    print "Sweeping %d configurations with %s workers."%(len(configs), jobs or "one per core")
+    results, (network, pcas, phones) = run_sweep( filename, configs, jobs, batchsize, momentum,
+                                                  epochs, epochbatches, scheduler=scheduler )
+    table = format_results( results )
+    print table
+    with open( resultsfile, 'w' ) as f:
+        f.write( table + "\n" )
+    print "Saved results to %s"%resultsfile
+    if network.save( pcas, phones, outputfile ):
+        print "Saved best nn successfully"
+    else: print "Error while saving nn"
+
 def validateNN( nnfile ):
+    from network import NetFileError, loadNN
+    try:
+        loadNN( nnfile )
+        print "Valid NeuralNet file."
+    except NetFileError as e:
+        print "INVALID NeuralNet file, please regenerate. %s"%e
+
+def validateTable( tablefile ):
+    from LookupTable import LookupTable, TableFileError
     try:
-        res = loadNN( nnfile )
-        if res is not None:
-            print "Valid NeuralNet file."
-        else: print "INVALID NeuralNet file, please regenerate."
-    except: print "INVALID NeuralNet file, please regenerate."
-
-def testWord( nnfile, word ):
-    pcas, phones, nn = loadNN( nnfile )
-    fgen = FeatureGenerator(None)
-    wordc = [c for c in word.lower()]
-    vectors = fgen.word_vectors( wordc )
-    print "For word: %s"%word
-#    print "Phonemes: %d, %s"%(len(phones),str(phones))
-    for c, v in vectors:
-        pp = zip( nn.run(v), phones )
-#        print sorted(pp,reverse=True)
-        (_,best_pronunciation) = sorted(pp,reverse=True)[0] 
-        print "char: %s, pronunciation: %s"%(c,best_pronunciation)
-
-def splitTrainingSet( trainFile, splitSize ):
-    if splitSize < 0 or splitSize > 1:
-        print "Split size must be within 0.0 and 1.0 NON-inclusive."
+        LookupTable( tablefile ).close()
+        print "Valid lookup table file."
+    except TableFileError as e:
+        print "INVALID lookup table file, please export it again. %s"%e
+
+def convertNNFile( nnfile, outputfile ):
+    from network import NetFileError, convertNN
+    try:
+        convertNN( nnfile, outputfile )
+        print "Converted %s to %s"%(nnfile,outputfile)
+    except NetFileError as e:
+        print "Could not convert NeuralNet file: %s"%e
+
+def comparePrecision( nnfile, precision, datafile ):
+    from time import time
+    from FeatureGenerator import FeatureGenerator
+    from network import NetFileError, compare_outputs
+    from PhonemeDataFile import PhonemeDataFile
+    from Pronouncer import Pronouncer
+    try:
+        reference = Pronouncer.load( nnfile, precision='float64' )
+        compiled = Pronouncer.load( nnfile, precision=precision )
+    except NetFileError as e:
+        print "Could not load NeuralNet file: %s"%e
+        return
+    index = dict( (p, i) for i, p in enumerate(reference.phones) )
+    words, labels = [], []
+    for w, p in PhonemeDataFile( datafile ).readWordSplit():
+        if all( c in FeatureGenerator.ALPHABET for c in w ):
+            words.append( w )
+            labels.extend( index.get(c, -1) for c in p[:len(w)] )
+    timings = []
+    for pronouncer in [reference, compiled]:
+        start = time()
+        outputs = pronouncer.outputs( words )
+        timings.append( (outputs, time() - start) )
+    report = compare_outputs( timings[0][0], timings[1][0], labels )
+    print "Comparing %s against float64 on %d characters:"%(precision, report['samples'])
+    for key in sorted( report ):
+        print "%s: %s"%(key, report[key])
+    for name, pronouncer, (_, elapsed) in zip( ['float64', precision], [reference, compiled], timings ):
+        print "%s: %d weight bytes, %.1f chars/s"%(name, pronouncer._net.nbytes,
+                                                   report['samples'] / max(elapsed, 1e-9))
+
+def testWord( nnfile, word, cachesize=0, cachefile=None, beam=0, topk=1, bigramfile=None, precision=None ):
+    from network import NetFileError
+    from Pronouncer import Pronouncer, clean_word, format_pronunciation
+    try:
+        pronouncer = Pronouncer.load( nnfile, cachesize, cachefile, 0, beam, bigramfile, precision )
+    except NetFileError as e:
+        print "Could not load NeuralNet file: %s"%e
+        return
+    chars = clean_word( word )
+    if topk > 1:
+        print "For word: %s"%word
+        for rank, (pron, score) in enumerate( pronouncer.pronounce_topk( [chars], topk )[0] ):
+            print "%d. %s\t(log p = %.4f)"%(rank + 1, ' '.join(pron), score)
+    else:
+        pron = pronouncer.pronounce( [chars] )[0]
+        print format_pronunciation( word, chars, pron, 'chars' )
+    if pronouncer.cache is not None and cachefile is not None:
+        pronouncer.cache.save( cachefile )
+
+def exportTable( nnfile, tablefile, topk=1, precision=None ):
+    from network import NetFileError
+    from Pronouncer import Pronouncer
+    from time import time
+    try:
+        pronouncer = Pronouncer.load( nnfile, precision=precision )
+    except NetFileError as e:
+        print "Could not load NeuralNet file: %s"%e
+        return
+    start = time()
+    num = pronouncer.export_table( tablefile, topk )
+    print "Saved the best %d phones of %d windows to %s in %.2fs."%(min(topk, len(pronouncer.phones)),
+        num, tablefile, time() - start)
+
+def tableWord( tablefile, word, topk=1 ):
+    from LookupTable import LookupTable, TableFileError
+    try:
+        table = LookupTable( tablefile )
+    except TableFileError as e:
+        print "Could not load lookup table file: %s"%e
         return
-    dat = []
-    f = PhonemeDataFile( trainFile )
-    for word in f.readWord():
-        dat.append(word)
-    shuffle(dat)
+    with table:
+        chars = table.clean_word( word )
+        print "For word: %s"%word
+        for c, phones in zip( chars, table.pronounce_topk( chars ) ):
+            print "char: %s, pronunciation: %s"%(c, ' '.join(phones[:topk]))
 
-    split = int(splitSize * len(dat))
-    firstHalf = dat[:split]
-    secondHalf = dat[split:]
+def tableWords( tablefile, inputfile, outputfile, fmt, blocksize ):
+    from LookupTable import LookupTable, TableFileError
+    from Pronouncer import OUTPUT_FORMATS, read_words, word_blocks, write_pronunciations
+    if fmt not in OUTPUT_FORMATS:
+        print >>sys.stderr, "Unknown output format: %s, please use one of %s."%(fmt,", ".join(OUTPUT_FORMATS))
+        return
+    try:
+        table = LookupTable( tablefile )
+    except TableFileError as e:
+        print >>sys.stderr, "Could not load lookup table file: %s"%e
+        return
+    inp = sys.stdin if inputfile == '-' else open( inputfile, 'r' )
+    out = sys.stdout if outputfile is None else open( outputfile, 'w' )
+    try:
+        results = (r for block in word_blocks(read_words(inp), blocksize) for r in table.pronounce_block(block))
+        count = write_pronunciations( results, out, fmt )
+    finally:
+        table.close()
+        if inp is not sys.stdin: inp.close()
+        if out is not sys.stdout: out.close()
+    print >>sys.stderr, "Pronounced %d words."%count
 
+def pronounceWords( nnfile, inputfile, outputfile, fmt, blocksize, jobs=1, cachesize=0, cachefile=None,
+                    windowcache=0, beam=0, bigramfile=None, precision=None ):
+    from network import NetFileError
+    from Pronouncer import (OUTPUT_FORMATS, Pronouncer, parallel_pronounce, read_words,
+                            write_pronunciations)
+    if fmt not in OUTPUT_FORMATS:
+        print >>sys.stderr, "Unknown output format: %s, please use one of %s."%(fmt,", ".join(OUTPUT_FORMATS))
+        return
+    try:
+        if jobs == 1:
+            pronouncer = Pronouncer.load( nnfile, cachesize, cachefile, windowcache, beam, bigramfile,
+                                          precision )
+    except NetFileError as e:
+        print >>sys.stderr, "Could not load NeuralNet file: %s"%e
+        return
+    inp = sys.stdin if inputfile == '-' else open( inputfile, 'r' )
+    out = sys.stdout if outputfile is None else open( outputfile, 'w' )
+    stats = {}
+    try:
+        if jobs == 1:
+            count = pronouncer.pronounce_stream( read_words(inp), out, fmt, blocksize )
+            if pronouncer.cache is not None:
+                stats.update( pronouncer.cache.stats() )
+                if cachefile is not None: pronouncer.cache.save( cachefile )
+            if pronouncer.window_cache is not None:
+                stats['window_hits'] = pronouncer.window_cache.hits
+                stats['window_misses'] = pronouncer.window_cache.misses
+        else:
+            results = parallel_pronounce( nnfile, read_words(inp), jobs, blocksize,
+                                          cache_size=cachesize, cache_file=cachefile, stats=stats,
+                                          window_cache_size=windowcache, beam_width=beam,
+                                          bigram_file=bigramfile, precision=precision )
+            count = write_pronunciations( results, out, fmt )
+    except NetFileError as e:
+        print >>sys.stderr, "Could not load NeuralNet file: %s"%e
+        return
+    finally:
+        if inp is not sys.stdin: inp.close()
+        if out is not sys.stdout: out.close()
+    print >>sys.stderr, "Pronounced %d words."%count
+    if cachesize > 0:
+        print >>sys.stderr, "Word cache: %d hits, %d misses."%(stats.get('hits',0),stats.get('misses',0))
+    if windowcache:
+        print >>sys.stderr, "Window cache: %d hits, %d misses (per character)."%(stats.get('window_hits',0),
+                                                                                 stats.get('window_misses',0))
+
+def serveNN( nnfile, host, port, maxbatch, maxdelay, cachesize=0, windowcache=0, beam=0, bigramfile=None,
+             precision=None ):
+    from network import NetFileError
+    from Pronouncer import Pronouncer
+    from PronunciationServer import PronunciationServer
+    try:
+        pronouncer = Pronouncer.load( nnfile, cachesize, None, windowcache, beam, bigramfile, precision )
+    except NetFileError as e:
+        print "Could not load NeuralNet file: %s"%e
+        return
+    server = PronunciationServer( pronouncer, host, port, maxbatch, maxdelay / 1000.0 )
+    print "Serving %s on http://%s:%d/"%(nnfile,host,server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def splitTrainingSet( trainFile, splitSize, cached=False, seed=0, encode=False ):
+    from splitter import parse_weights, split_file
+    try:
+        weights = parse_weights( splitSize )
+    except ValueError as e:
+        print e
+        return
     fname,ext = os.path.splitext(trainFile)
+    if encode: ext = ".pdc"
+    files = ["%s_%d%s"%(fname,i+1,ext) for i in range(len(weights))]
+    counts = split_file( trainFile, files, weights, seed, cached, encode )
+    print "Success, your %d files are located at:"%len(files)
+    print "  and  ".join( "%s (%d words)"%(f,n) for f,n in zip(files,counts) )
 
-    with open( fname+"_1"+ext, 'w' ) as a:
-        for (word,deff) in firstHalf:
-            a.write(word)
-            a.write(deff)
-    with open( fname+"_2"+ext, 'w' ) as b:
-        for (word,deff) in secondHalf:
-            b.write(word)
-            b.write(deff)
-    print "Success, your two files are located at:"
-    print "%s_1%s  and  %s_2%s"%(fname,ext,fname,ext)
+def foldTrainingSet( trainFile, folds, cached=False, seed=0, encode=False ):
+    from splitter import kfold_file
+    if folds < 2:
+        print "Number of folds must be at least 2."
+        return
+    fname,ext = os.path.splitext(trainFile)
+    if encode: ext = ".pdc"
+    trains = ["%s_fold%d_train%s"%(fname,i+1,ext) for i in range(folds)]
+    tests = ["%s_fold%d_test%s"%(fname,i+1,ext) for i in range(folds)]
+    counts = kfold_file( trainFile, trains, tests, seed, cached, encode )
+    print "Success, your %d folds are located at:"%folds
+    for train,test,n in zip(trains,tests,counts):
+        print "%s  and  %s (%d test words)"%(train,test,n)
 
 
 def main(opts):
-    print opts
+    print >>sys.stderr, opts
     if opts.trainfile is not None:
-        if opts.splitsize is not None:
-            splitTrainingSet(opts.trainfile, opts.splitsize)
+        if opts.folds is not None:
+            foldTrainingSet(opts.trainfile, opts.folds, opts.cache, opts.splitseed, opts.encode)
+        elif opts.splitsize is not None:
+            splitTrainingSet(opts.trainfile, opts.splitsize, opts.cache, opts.splitseed, opts.encode)
         else:
             if opts.numlayers < 1: 
                 print "Warning: Number of layers is less than 1, using 1 instead."
@@ -118,10 +511,132 @@ def main(opts):
             if opts.numhidden < 1: 
                 print "Warning: Number of hidden nodes is less than 1, using 1 instead."
                 opts.numhidden=1
-            makeNN( opts.trainfile, opts.savefile, opts.numhidden, opts.pca, opts.numlayers )
+            if opts.batchsize is not None and opts.batchsize < 1:
+                print "Warning: Batch size is less than 1, training one sample at a time."
+                opts.batchsize=None
+            if opts.jobs < 0:
+                print "Warning: Number of jobs is less than 0, using 1 instead."
+                opts.jobs=1
+            if opts.learningrate <= 0:
+                print "Warning: Learning rate is not above 0, using 0.1 instead."
+                opts.learningrate=0.1
+            if opts.lrdecay <= 0 or opts.lrdecay > 1:
+                print "Warning: Learning rate decay is not within 0 and 1, not decaying."
+                opts.lrdecay=1.0
+            if opts.plateaufactor <= 0 or opts.plateaufactor > 1:
+                print "Warning: Plateau factor is not within 0 and 1, using 0.5 instead."
+                opts.plateaufactor=0.5
+            if opts.patience < 0:
+                print "Warning: Patience is less than 0, using 0 instead."
+                opts.patience=0
+            from TrainingScheduler import TrainingScheduler
+            scheduler = TrainingScheduler( opts.patience, opts.lrdecay, max(opts.plateau, 0), opts.plateaufactor,
+                                           opts.minlr, opts.targetrmse,
+                                           opts.savefile if opts.checkpoint and opts.sweep is None else None,
+                                           opts.learningrate,
+                                           max(opts.mindelta, 0.0) )
+            if opts.sweep is not None:
+                if opts.checkpoint:
+                    print "Warning: --checkpoint is not used with --sweep, only the best net is saved."
+                sweepNN( opts.trainfile, opts.sweep, opts.sweepsamples, opts.savefile, opts.sweepresults,
+                         opts.jobs or None, opts.batchsize or 256, opts.momentum,
+                         max(opts.epochs, 1), opts.epochbatches, scheduler )
+                return
+            if opts.stream and opts.buffersize < 1:
+                print "Warning: Shuffle buffer is less than 1, not shuffling."
+                opts.buffersize=0
+            if not opts.cache and not opts.stream and opts.jobs != 1 and opts.batchsize is None:
+                print "Warning: Parallel training needs mini-batches (-b), using 1 job instead."
+                opts.jobs=1
+            monitor = None
+            if opts.logfile is not None or opts.profilefile is not None:
+                from TrainingMonitor import TrainingLog
+                monitor = TrainingLog( opts.logfile, opts.logbatches, opts.profilefile )
+            try:
+                if opts.finetune is not None:
+                    fineTuneNN( opts.finetune, opts.trainfile, opts.basefile, opts.savefile, max(opts.replay, 0.0),
+                                max(opts.epochs, 1), opts.batchsize, opts.momentum, monitor, scheduler )
+                elif opts.cache:
+                    makeNNCached( opts.trainfile, opts.savefile, opts.numhidden, opts.pca, opts.numlayers,
+                                  opts.batchsize or 256, opts.momentum, opts.epochbatches, opts.jobs or None,
+                                  monitor, scheduler, epochs=max(opts.epochs, 1) )
+                elif opts.stream:
+                    makeNNStream( opts.trainfile, opts.savefile, opts.numhidden, opts.pca, opts.numlayers,
+                                  opts.batchsize or 256, opts.momentum, opts.buffersize, opts.epochbatches,
+                                  opts.jobs or None, monitor, scheduler, epochs=max(opts.epochs, 1) )
+                else:
+                    makeNN( opts.trainfile, opts.savefile, opts.numhidden, opts.pca, opts.numlayers,
+                            opts.batchsize, opts.momentum, opts.jobs or None, monitor, scheduler,
+                            epochs=max(opts.epochs, 1) )
+            finally:
+                if monitor is not None: monitor.close()
     elif opts.nnfile is not None:
-        if opts.word is not None:
-            testWord( opts.nnfile, opts.word )
+        if opts.topk < 1:
+            print >>sys.stderr, "Warning: Top k is less than 1, using 1 instead."
+            opts.topk=1
+        if opts.bigramfile is not None and opts.beam < 1:
+            print >>sys.stderr, "Warning: Bigrams need a beam search, using a beam width of 8."
+            opts.beam=8
+        if opts.precision is not None:
+            from network import PRECISIONS
+            if opts.precision not in PRECISIONS:
+                print >>sys.stderr, "Unknown precision: %s, please use one of %s."%(opts.precision,", ".join(PRECISIONS))
+                return
+        if not os.path.isfile( opts.nnfile ):
+            print >>sys.stderr, "No such NeuralNet or lookup table file: %s"%opts.nnfile
+            return
+        from LookupTable import is_table_file
+        table = is_table_file( opts.nnfile )
+        if table:
+            unsupported = [name for name, used in [('-j', opts.jobs != 1), ('--bigram', opts.bigramfile is not None),
+                                                   ('--beam', opts.beam > 0 and opts.bigramfile is None), ('--word-cache', opts.cachesize > 0),
+                                                   ('--word-cache-file', opts.cachefile is not None),
+                                                   ('--window-cache', opts.windowcache != 0),
+                                                   ('--precision', opts.precision is not None),
+                                                   ('--serve', opts.port is not None),
+                                                   ('--export-table', opts.tablefile is not None),
+                                                   ('--convert', opts.convertfile is not None),
+                                                   ('--compare', opts.comparefile is not None)] if used]
+            if unsupported:
+                print >>sys.stderr, "A lookup table can't be used with %s, please give it the net instead."%(
+                    ", ".join(unsupported))
+                return
+        if (opts.port is not None or opts.inputfile is not None) and not table and opts.tablefile is None \
+           and opts.convertfile is None and opts.topk > 1 and opts.beam < opts.topk:
+            print >>sys.stderr, "The beam width (%d) is less than --topk (%d), please use --beam %d or more."%(
+                opts.beam, opts.topk, opts.topk)
+            return
+        if opts.convertfile is not None:
+            convertNNFile( opts.nnfile, opts.convertfile )
+        elif opts.tablefile is not None:
+            exportTable( opts.nnfile, opts.tablefile, opts.topk, opts.precision )
+        elif opts.port is not None:
+            serveNN( opts.nnfile, opts.host, opts.port, max(opts.maxbatch, 1), max(opts.maxdelay, 0.0),
+                     opts.cachesize, opts.windowcache, opts.beam, opts.bigramfile, opts.precision )
+        elif opts.inputfile is not None:
+            if opts.blocksize < 1:
+                print >>sys.stderr, "Warning: Block size is less than 1, using 1 instead."
+                opts.blocksize=1
+            if opts.jobs < 0:
+                print >>sys.stderr, "Warning: Number of jobs is less than 0, using 1 instead."
+                opts.jobs=1
+            if table:
+                tableWords( opts.nnfile, opts.inputfile, opts.outputfile, opts.format, opts.blocksize )
+            else:
+                pronounceWords( opts.nnfile, opts.inputfile, opts.outputfile, opts.format, opts.blocksize,
+                                opts.jobs or None, opts.cachesize, opts.cachefile, opts.windowcache,
+                                opts.beam, opts.bigramfile, opts.precision )
+        elif opts.word is not None and table:
+            tableWord( opts.nnfile, opts.word, opts.topk )
+        elif opts.word is not None:
+            if opts.topk > 1 and opts.beam < opts.topk:
+                opts.beam=opts.topk
+            testWord( opts.nnfile, opts.word, opts.cachesize, opts.cachefile, opts.beam, opts.topk,
+                      opts.bigramfile, opts.precision )
+        elif opts.comparefile is not None:
+            comparePrecision( opts.nnfile, opts.precision or 'float32', opts.comparefile )
+        elif table:
+            validateTable( opts.nnfile )
         else:
             validateNN( opts.nnfile )
     else: gen_optparse().print_usage()
@@ -0,0 +1,142 @@
+"""
+    Splits a data set into parts in a single streaming pass, so memory does
+    not grow with the size of the lexicon.
+
+    Each word goes to a part picked by hashing it (see
+    PhonemeDataFile.hash_fraction()) rather than by shuffling, so the same
+    word always lands in the same part for the same seed, duplicates never
+    straddle two parts, and nothing has to be held in memory. The parts are
+    either a multi-way split by weight, e.g. 0.8,0.1,0.1, or the train and
+    test files of each of k folds.
+
+    The parts are written as text in the PhonemeDataFile format through
+    buffered bulk writes, or encoded straight into DatasetCache files that
+    share one phone list, ready for training with -c.
+"""
+
+from bisect import bisect_right
+
+from PhonemeDataFile import PhonemeDataFile, hash_fraction
+
+FLUSH_LINES = 1 << 14
+
+def parse_weights(spec):
+    """ Parses a split like '0.8' (meaning 0.8,0.2) or '0.8,0.1,0.1' into a
+    list of weights summing to 1.
+    """
+    weights = [float(w) for w in str(spec).split(',') if w.strip()]
+    if len(weights) == 1:
+        if not 0 < weights[0] < 1:
+            raise ValueError('Split size must be within 0.0 and 1.0 NON-inclusive.')
+        weights.append(1 - weights[0])
+    if len(weights) < 2 or any(w <= 0 for w in weights):
+        raise ValueError('Split weights must all be greater than 0: %s' % spec)
+    total = sum(weights)
+    return [w / total for w in weights]
+
+def word_key(word):
+    """ The hashing key of a word line, ignoring whitespace differences. """
+    return ' '.join(word.split())
+
+def part_of(word, bounds, seed=0):
+    """ Which part a word line goes to, given the cumulative weights of all
+    but the last part.
+    """
+    return bisect_right(bounds, hash_fraction(word_key(word), seed))
+
+def fold_of(word, k, seed=0):
+    """ Which of k folds a word line is tested in. """
+    return min(int(hash_fraction(word_key(word), seed) * k), k - 1)
+
+
+class TextPart:
+    """ A part written as text, a buffer of lines at a time. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.num_words = 0
+        self._file = open(filename, 'w')
+        self._lines = []
+
+    def add(self, word, pron):
+        self._lines.append(word)
+        self._lines.append(pron)
+        self.num_words += 1
+        if len(self._lines) >= FLUSH_LINES:
+            self._flush()
+
+    def _flush(self):
+        self._file.writelines(self._lines)
+        self._lines = []
+
+    def close(self):
+        self._flush()
+        self._file.close()
+
+class EncodedPart:
+    """ A part encoded straight into a DatasetCache file. """
+
+    def __init__(self, filename, fgen, source, phone_index):
+        from DatasetCache import DatasetWriter
+        self.filename = filename
+        self._writer = DatasetWriter(filename, fgen, None, source, phone_index)
+
+    @property
+    def num_words(self):
+        return self._writer.num_words
+
+    def add(self, word, pron):
+        self._writer.add(word.split(), pron.split())
+
+    def close(self):
+        self._writer.close()
+
+def _open_parts(filenames, encoded, source):
+    if not encoded:
+        return [TextPart(f) for f in filenames]
+    from FeatureGenerator import FeatureGenerator
+    fgen = FeatureGenerator(None)
+    phone_index = {}
+    return [EncodedPart(f, fgen, source, phone_index) for f in filenames]
+
+def _words(source, cached):
+    if cached:
+        from DatasetCache import DatasetCache
+        return DatasetCache.open(source).words()
+    return PhonemeDataFile(source).readWord()
+
+def split_file(source, filenames, weights, seed=0, cached=False, encoded=False):
+    """ Splits the words of source between filenames by weight. Returns the
+    number of words written to each.
+    """
+    bounds = []
+    for w in weights[:-1]:
+        bounds.append((bounds[-1] if bounds else 0.0) + w)
+    parts = _open_parts(filenames, encoded, source)
+    try:
+        for word, pron in _words(source, cached):
+            parts[part_of(word, bounds, seed)].add(word, pron)
+    finally:
+        for part in parts:
+            part.close()
+    return [part.num_words for part in parts]
+
+def kfold_file(source, train_files, test_files, seed=0, cached=False, encoded=False):
+    """ Writes the k = len(test_files) folds of source: each word goes to the
+    test file of its fold and the train files of every other fold. Returns
+    the number of words in each test file.
+    """
+    k = len(test_files)
+    trains = _open_parts(train_files, encoded, source)
+    tests = _open_parts(test_files, encoded, source)
+    try:
+        for word, pron in _words(source, cached):
+            fold = fold_of(word, k, seed)
+            tests[fold].add(word, pron)
+            for i, part in enumerate(trains):
+                if i != fold:
+                    part.add(word, pron)
+    finally:
+        for part in trains + tests:
+            part.close()
+    return [part.num_words for part in tests]
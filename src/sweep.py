@@ -0,0 +1,168 @@
+"""
+    Hyperparameter sweeps: trains a NeuralNet for every setting of a grid (or a
+    random sample of it) in parallel worker processes, and keeps the best one.
+
+    The data set is compiled into a DatasetCache once and every worker
+    memory-maps that same file, with the same held out words, so the candidates
+    are scored on identical data. The PCA basis, when needed, is also worked out
+    once up front.
+
+    A grid spec lists the values to try per parameter, e.g.
+
+        hidden=50,100,150;layers=1,2;pca=0,40
+
+    where pca=0 means no PCA. It can also be the name of a JSON file holding the
+    same as a dictionary of lists.
+
+    Each worker saves its net to a scratch file and only hands back its
+    scores, so the sweep never holds more than the best net in memory however
+    wide the grid is.
+"""
+
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+PARAMETERS = ['hidden', 'layers', 'pca']
+DEFAULTS = {'hidden': [50], 'layers': [1], 'pca': [0]}
+COLUMNS = PARAMETERS + ['misclassified', 'rmse', 'epochs', 'train_s', 'latency_ms']
+
+def parse_grid(spec):
+    """ Parses a grid spec into a dictionary of the values for each parameter. """
+    if os.path.isfile(spec):
+        with open(spec) as f:
+            grid = json.load(f)
+    else:
+        grid = {}
+        for part in spec.split(';'):
+            if not part.strip():
+                continue
+            name, _, values = part.partition('=')
+            grid[name.strip()] = [int(v) for v in values.split(',') if v.strip()]
+
+    for name in grid:
+        if name not in PARAMETERS:
+            raise ValueError('Unknown sweep parameter: %s, expected one of %s' % (name, ', '.join(PARAMETERS)))
+        if not grid[name]:
+            raise ValueError('No values given for sweep parameter: %s' % name)
+    full = dict(DEFAULTS)
+    full.update((name, [int(v) for v in values]) for name, values in grid.items())
+    return full
+
+def grid_configs(grid, samples=None, seed=None):
+    """ Lists every combination of the grid, or a random sample of them. """
+    configs = [dict(zip(PARAMETERS, values))
+               for values in itertools.product(*[grid[p] for p in PARAMETERS])]
+    if samples is not None and samples < len(configs):
+        configs = random.Random(seed).sample(configs, samples)
+    return configs
+
+def _run_config(args):
+    """ Trains and scores one configuration inside a worker process, with its
+    training output silenced.
+    """
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            return _train_config(*args)
+        finally:
+            sys.stdout = stdout
+
+def _train_config(config, cache_file, pcas, opts, netfile):
+    """ Trains and scores one configuration, saving the net to netfile.
+    Returns its result row.
+    """
+    from DatasetCache import DatasetCache
+    from FeatureGenerator import run_pca
+    from network import NeuralNet
+    from numpy.random import RandomState, seed as np_seed
+
+    np_seed(opts['seed'])
+    random.seed(opts['seed'])
+
+    cache = DatasetCache(cache_file)
+    heldout = cache.sample_mask(cache.word_mask(opts['holdout'], opts['seed']))
+    rows = heldout.nonzero()[0][:opts['valsize'] + opts['testsize']]
+
+    project = lambda x: x
+    if config['pca']:
+        project = lambda x: run_pca(x, pcas, config['pca'])
+    samples = zip(project(cache.inputs(rows)), cache.truths(rows))
+    val, test = samples[:opts['valsize']], samples[opts['valsize']:]
+
+    def batches():
+        return ((project(x), t) for x, t in cache.batches(opts['batchsize'], ~heldout, rng=RandomState(opts['seed'])))
+
+    structure = [config['pca'] or cache.width] + [config['hidden']] * config['layers'] + [len(cache.phones)]
+    nn = NeuralNet(structure)
+    start = time.time()
+    num_epochs = nn.train_stream(batches, val, test, epochs=opts['epochs'],
+                                 batches_per_epoch=opts['epochbatches'], momentum=opts['momentum'],
+                                 scheduler=opts['scheduler'])
+    train_time = time.time() - start
+    misclassified, rmse, _ = nn.test(test, to_print=False)
+
+    inputs = [x for x, _ in test[:200]]
+    start = time.time()
+    for x in inputs:
+        nn.run_batch(x)
+    latency = (time.time() - start) * 1000 / max(len(inputs), 1)
+
+    result = dict(config)
+    result.update(misclassified=misclassified, rmse=rmse, train_s=train_time, latency_ms=latency,
+                  epochs=num_epochs)
+    if not nn.save(pcas if config['pca'] else None, cache.phones, netfile, True):
+        raise IOError('Could not save the sweep net to %s' % netfile)
+    return result
+
+def run_sweep(datafile, configs, jobs=None, batchsize=256, momentum=0.0, epochs=500, epochbatches=None,
+              holdout=0.2, valsize=1000, testsize=10000, seed=0, scheduler=None):
+    """ Trains every configuration on the data file across jobs worker
+    processes, each with its own copy of the TrainingScheduler if one is
+    given. Returns the list of result rows, in the order of configs, and
+    the best (nn, pcas, phones), judged by misclassification then RMSE.
+    """
+    from multiprocessing import Pool
+    from DatasetCache import DatasetCache
+    from FeatureGenerator import gen_pca_stream
+    from network import loadNN
+
+    cache = DatasetCache.open(datafile)
+    pcas = None
+    if any(c['pca'] for c in configs):
+        heldout = cache.sample_mask(cache.word_mask(holdout, seed))
+        _, pcas = gen_pca_stream(x for x, _ in cache.batches(1 << 14, ~heldout, shuffle=False))
+
+    opts = dict(batchsize=batchsize, momentum=momentum, epochs=epochs, epochbatches=epochbatches,
+                holdout=holdout, valsize=valsize, testsize=testsize, seed=seed, scheduler=scheduler)
+    scratch = tempfile.mkdtemp(prefix='sweep')
+    try:
+        netfiles = [os.path.join(scratch, '%d.nnb' % i) for i in range(len(configs))]
+        tasks = [(config, cache.filename, pcas, opts, f) for config, f in zip(configs, netfiles)]
+        pool = Pool(jobs)
+        try:
+            results = pool.map(_run_config, tasks, chunksize=1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        best = min(range(len(results)), key=lambda i: (results[i]['misclassified'], results[i]['rmse']))
+        best_pcas, phones, nn = loadNN(netfiles[best], mmap=False)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return results, (nn, best_pcas, phones)
+
+def format_results(results):
+    """ Formats result rows as a tab separated table, best first. """
+    rows = sorted(results, key=lambda r: (r['misclassified'], r['rmse']))
+    lines = ['\t'.join(COLUMNS)]
+    for r in rows:
+        lines.append('\t'.join(('%.6f' % r[c]) if isinstance(r[c], float) else str(r[c]) for c in COLUMNS))
+    return '\n'.join(lines)
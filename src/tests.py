@@ -2,8 +2,11 @@
 #
 # Run some tests on our Neural Net and feature extractor.
 #
+import os
 import profile
+import subprocess
 import sys
+import time
 
 from FeatureGenerator import FeatureGenerator
 from PhonemeDataFile import PhonemeDataFile
@@ -39,14 +42,172 @@ def test2(f):
 def test3(f):
     profile.run('testOnNet("%s")'%f)
 
+def startupTime(args, runs=10):
+    """Median wall time in ms of running the given command."""
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(args, stdout=devnull, stderr=devnull)
+            times.append((time.time() - start) * 1000)
+    return sorted(times)[len(times) // 2]
+
+def test4(f):
+    """Startup time benchmark, where f is a trained neural net file."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    phonemer = os.path.join(here, 'phonemer.py')
+    cases = [
+        ('python', [sys.executable, '-c', 'pass']),
+        ('import numpy', [sys.executable, '-c', 'import numpy']),
+        ('import phonemer', [sys.executable, '-c', 'import sys; sys.path.insert(0, %r); import phonemer' % here]),
+        ('phonemer.py -h', [sys.executable, phonemer, '-h']),
+        ('phonemer.py -t N', [sys.executable, phonemer, '-t', f]),
+        ('phonemer.py -t N -w W', [sys.executable, phonemer, '-t', f, '-w', 'phonemer']),
+    ]
+    for name, args in cases:
+        print '%-24s %8.1f ms'%(name, startupTime(args))
+
+def trainingThroughput(net, inputs, truths, batch_size, workers=None):
+    """Samples per second of one pass of mini-batch steps, on 1 process
+    when workers is None, otherwise across a ParallelTrainer."""
+    from ParallelTrainer import ParallelTrainer
+    if workers is None:
+        step, trainer = net.backprop_batch, None
+    else:
+        trainer = ParallelTrainer(net, workers, batch_size).start()
+        step = trainer.step
+    start = time.time()
+    for i in range(0, len(inputs), batch_size):
+        step(inputs[i:i+batch_size], truths[i:i+batch_size])
+    elapsed = time.time() - start
+    if trainer is not None:
+        trainer.close()
+    return len(inputs) / elapsed
+
+def test5(f, batch_size=1024, hidden=150):
+    """Data-parallel training speedup as workers are added."""
+    from multiprocessing import cpu_count
+    from network import samples_to_arrays
+    features,_ = FeatureGenerator(PhonemeDataFile(f)).features_vector()
+    inputs, truths = samples_to_arrays(features)
+    nin,nout = inputs.shape[1],truths.shape[1]
+    counts = sorted(set([1, 2, 4, cpu_count()]))
+    base = trainingThroughput(NeuralNet((nin, hidden, nout)), inputs, truths, batch_size)
+    print 'cores: %d, samples: %d, batch: %d'%(cpu_count(), len(inputs), batch_size)
+    print '%-10s %12.0f samples/s'%('serial', base)
+    for n in counts:
+        rate = trainingThroughput(NeuralNet((nin, hidden, nout)), inputs, truths, batch_size, n)
+        print '%-10s %12.0f samples/s  %5.2fx'%('%d workers'%n, rate, rate / base)
+
+def test6(f, nnfile, num_words=2000):
+    """Beam search accuracy and latency at each beam width, with and without
+    phone bigrams learned from f, on the first num_words words of f."""
+    from Decoder import BigramModel
+    from Pronouncer import Pronouncer
+    pronouncer = Pronouncer.load(nnfile)
+    data = []
+    for w, p in PhonemeDataFile(f).readWordSplit():
+        if len(data) >= num_words: break
+        data.append((w, p))
+    words = [w for w, _ in data]
+    bigram = BigramModel.learn(f, pronouncer.phones)
+    print '%-6s %-7s %9s %9s %12s'%('beam', 'bigram', 'word acc', 'char acc', 'ms/word')
+    for model in [None, bigram]:
+        for width in [0, 1, 2, 4, 8, 16]:
+            if width == 0 and model is not None: continue
+            pronouncer.use_beam(width, model)
+            start = time.time()
+            prons = pronouncer.pronounce(words)
+            elapsed = (time.time() - start) * 1000 / len(words)
+            chars = sum(len(p) for _, p in data)
+            char_hits = sum(a == b for (_, p), q in zip(data, prons) for a, b in zip(p, q))
+            word_hits = sum(p == q for (_, p), q in zip(data, prons))
+            print '%-6s %-7s %9.4f %9.4f %12.4f'%(width or 'argmax', 'yes' if model else 'no',
+                float(word_hits) / len(data), float(char_hits) / chars, elapsed)
+
+def lineReader(f, opener=open):
+    """The line at a time reader PhonemeDataFile.readWordSplit() replaced."""
+    prev = None
+    for line in opener(f, 'r'):
+        if line in [' ','']: continue
+        if prev == None:
+            prev = line
+        else:
+            yield (prev.split(), line.split())
+            prev = None
+
+def test7(f):
+    """Lines per second of the data file parsers, on f as it is and gzip and
+    bzip2 compressed copies of it."""
+    import bz2
+    import gzip
+    import shutil
+    import tempfile
+    readers = [('line at a time', None),
+               ('readWordSplit', lambda g: PhonemeDataFile(g).readWordSplit()),
+               ('readWordBlocks', lambda g: PhonemeDataFile(g).readWordBlocks())]
+    tmp = tempfile.mkdtemp()
+    try:
+        files = [('plain', f, open)]
+        for name, opener in [('gzip', gzip.open), ('bzip2', bz2.BZ2File)]:
+            copy = os.path.join(tmp, os.path.basename(f) + '.' + name)
+            with open(f, 'rb') as src:
+                dst = opener(copy, 'wb')
+                shutil.copyfileobj(src, dst)
+                dst.close()
+            files.append((name, copy, opener))
+        lines = sum(1 for l in open(f) if l.strip())
+        for kind, g, opener in files:
+            for name, reader in readers:
+                start = time.time()
+                for _ in reader(g) if reader else lineReader(g, opener): pass
+                elapsed = time.time() - start
+                print '%-6s %-15s %12.0f lines/s'%(kind, name, lines / elapsed)
+    finally:
+        shutil.rmtree(tmp)
+
+def test8(f, nnfile, num_words=5000):
+    """One word at a time latency of the net against a lookup table exported
+    from it, on the first num_words words of f."""
+    import tempfile
+    from LookupTable import LookupTable
+    from Pronouncer import Pronouncer
+    pronouncer = Pronouncer.load(nnfile)
+    words = []
+    for w, _ in PhonemeDataFile(f).readWordSplit():
+        if len(words) >= num_words: break
+        words.append(w)
+    fd, tablefile = tempfile.mkstemp('.plt')
+    os.close(fd)
+    try:
+        start = time.time()
+        pronouncer.export_table(tablefile)
+        print 'export: %.2fs, %d bytes'%(time.time() - start, os.path.getsize(tablefile))
+        with LookupTable(tablefile) as table:
+            for name, pronounce in [('net', lambda w: pronouncer.pronounce([w])[0]),
+                                    ('table', table.pronounce_word)]:
+                start = time.time()
+                prons = [pronounce(w) for w in words]
+                elapsed = time.time() - start
+                print '%-6s %10.1f us/word'%(name, elapsed * 1e6 / len(words))
+            same = sum(p == table.pronounce_word(w) for w, p in zip(words, pronouncer.pronounce(words)))
+            print 'agreement: %.4f'%(float(same) / len(words))
+    finally:
+        os.remove(tablefile)
+
 
 if __name__ == "__main__":
-    tests = [test1,test2,test3]
+    tests = [test1,test2,test3,test4,test5,test6,test7,test8]
     
-    if len(sys.argv)!=3:
+    if len(sys.argv)<3:
         print "Usage:\n\t%s <datafile> <test_number>"
         print "*Note: there are 1 to %d tests to choose from."%len(tests)
+        print "*Note: test 4 times CLI startup and takes a neural net file instead."
+        print "*Note: test 5 reports the speedup of data-parallel training over worker counts."
+        print "*Note: test 6 benchmarks beam search decoding and takes a neural net file after the number."
+        print "*Note: test 7 compares the data file parsers, on plain and compressed copies."
+        print "*Note: test 8 compares net and lookup table latency and takes a neural net file after the number."
     else: 
         f = sys.argv[1]
         i = int(sys.argv[2])-1
-        tests[i](f)
+        tests[i](f, *sys.argv[3:])